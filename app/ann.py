@@ -0,0 +1,176 @@
+"""
+位置を指定しない「全国」レコメンド用の近似最近傍(ANN)インデックス
+正規化した嗜好ベクトルを球面k-meansでクラスタに分け（IVF）、検索時はユーザーに
+近い n_probe 個のクラスタの商品だけを候補にすることで全件スコアリングを避ける
+
+インデックスの構築（k-means）は重いため、リクエストでは行わずカタログ更新のスレッドで行う
+カタログが更新されてから再構築が終わるまでは、前のインデックスを product_id で現在の行に引き直して使う
+"""
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+from app.pagination import top_k_indices
+from app.scoring import MIN_MATCH_PERCENTAGE, cosine_match_percentages
+
+# 割り当て計算時に一度に処理する行数（行数×クラスタ数の一時配列を抑える）
+ASSIGN_CHUNK_ROWS = 65536
+
+
+def _unit_rows(matrix: np.ndarray, row_norms: np.ndarray) -> np.ndarray:
+    return matrix / row_norms[:, None]
+
+
+def _nearest_centroids(unit_vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    assignments = np.empty(len(unit_vectors), dtype=np.int64)
+    for start in range(0, len(unit_vectors), ASSIGN_CHUNK_ROWS):
+        chunk = unit_vectors[start:start + ASSIGN_CHUNK_ROWS]
+        assignments[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+
+class IVFIndex:
+    """球面k-meansのクラスタ毎に行番号を連続して並べた転置リスト"""
+
+    def __init__(self, centroids: np.ndarray, list_rows: np.ndarray, list_offsets: np.ndarray,
+                 list_product_ids: Optional[np.ndarray] = None, version: Optional[int] = None):
+        self.centroids = centroids          # (n_lists, 16) 単位ベクトル
+        self.list_rows = list_rows          # クラスタ順に並べた行番号
+        self.list_offsets = list_offsets    # (n_lists + 1,) 各クラスタの [start, end)
+        self.list_product_ids = list_product_ids  # list_rows の各行の product_id（構築後のカタログ更新に追従する）
+        self.version = version              # 構築に使ったカタログのバージョン
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, matrix: np.ndarray, row_norms: np.ndarray, n_lists: Optional[int] = None,
+              iterations: int = 10, sample_size: int = 50000, seed: int = 0) -> "IVFIndex":
+        """
+        カタログの嗜好行列からインデックスを構築する
+        クラスタ中心はサンプルで学習し、全行の割り当てはチャンク単位で行う
+        ノルムが0の行はどのユーザーともスコア0になるため登録しない
+        """
+        valid = np.flatnonzero(row_norms > 0)
+        if len(valid) == 0:
+            return cls(np.zeros((0, matrix.shape[1])), np.empty(0, dtype=np.int64), np.zeros(1, dtype=np.int64))
+        unit_vectors = _unit_rows(matrix[valid], row_norms[valid])
+        n_lists = min(n_lists or max(1, int(np.sqrt(len(valid)))), len(valid))
+
+        rng = np.random.default_rng(seed)
+        sample = unit_vectors[rng.choice(len(unit_vectors), min(sample_size, len(unit_vectors)), replace=False)]
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = _nearest_centroids(sample, centroids)
+            sums = np.stack([np.bincount(assignments, weights=sample[:, d], minlength=n_lists) for d in range(sample.shape[1])], axis=1)
+            norms = np.linalg.norm(sums, axis=1)
+            # 空のクラスタは前回の中心をそのまま使う
+            filled = norms > 0
+            centroids[filled] = sums[filled] / norms[filled, None]
+
+        assignments = _nearest_centroids(unit_vectors, centroids)
+        order = np.argsort(assignments, kind="stable")
+        list_offsets = np.searchsorted(assignments[order], np.arange(n_lists + 1))
+        return cls(centroids, valid[order], list_offsets)
+
+    @classmethod
+    def build_for_catalog(cls, catalog, n_lists: Optional[int] = None) -> "IVFIndex":
+        index = cls.build(catalog.preferences, catalog.preference_norms, n_lists)
+        return cls(index.centroids, index.list_rows, index.list_offsets, catalog.product_ids[index.list_rows], catalog.version)
+
+    def search(self, user_vector: np.ndarray, n_probe: int, catalog=None) -> np.ndarray:
+        """
+        ユーザーベクトルに近い n_probe 個のクラスタに属する行番号を昇順で返す
+        catalog が構築時と異なるバージョンの場合は product_id から現在の行番号に引き直す（削除された商品は除く）
+        """
+        user_vector = np.asarray(user_vector, dtype=np.float64)
+        norm_user = np.linalg.norm(user_vector)
+        if norm_user <= 0 or self.n_lists == 0:
+            return np.empty(0, dtype=np.int64)
+        similarities = self.centroids @ (user_vector / norm_user)
+        n_probe = min(n_probe, self.n_lists)
+        probes = np.argpartition(-similarities, n_probe - 1)[:n_probe]
+        ranges = [slice(self.list_offsets[probe], self.list_offsets[probe + 1]) for probe in probes]
+        if catalog is None or catalog.version == self.version or self.list_product_ids is None:
+            return np.sort(np.concatenate([self.list_rows[r] for r in ranges]))
+        rows = catalog.rows_for_product_ids(np.concatenate([self.list_product_ids[r] for r in ranges]))
+        return np.sort(rows[rows >= 0])
+
+
+# --- 公開中のインデックス（カタログ更新のスレッドで差し替える） ---
+_index_lock = threading.Lock()
+_index: Optional[IVFIndex] = None
+_index_built_at = 0.0
+
+
+def get_ivf_index() -> Optional[IVFIndex]:
+    """公開中のインデックスを返す（未構築の場合はNone）。リクエストの処理中に構築は行わない"""
+    return _index
+
+
+def refresh_ivf_index(catalog, n_lists: Optional[int] = None, min_interval: float = 0.0) -> bool:
+    """
+    カタログのバージョンが変わっていれば、呼び出し元のスレッドでインデックスを再構築して差し替える
+    前回の構築から min_interval 秒以内は再構築しない（差分更新が続いても構築し続けないようにする）
+    再構築した場合はTrueを返す
+    """
+    global _index, _index_built_at
+    if catalog is None:
+        return False
+    with _index_lock:
+        if _index is not None and (
+            _index.version == catalog.version or time.monotonic() - _index_built_at < min_interval
+        ):
+            return False
+        index = IVFIndex.build_for_catalog(catalog, n_lists)
+        _index, _index_built_at = index, time.monotonic()
+        return True
+
+
+def _top_k_rows(catalog, user_vector, rows: np.ndarray, k: int) -> np.ndarray:
+    scores = cosine_match_percentages(user_vector, catalog.preferences[rows], catalog.preference_norms[rows])
+    matched = scores >= MIN_MATCH_PERCENTAGE
+    rows, scores = rows[matched], scores[matched]
+    return rows[top_k_indices(scores, catalog.product_ids[rows], k)]
+
+
+def recall_at_k(catalog, index: IVFIndex, query_vectors: np.ndarray, k: int, n_probe: int) -> dict:
+    """
+    完全スコアリングの上位k件に対するANN検索の再現率(recall@k)を測定する
+    上位k件が空になるクエリ（40%以上の商品がない）は集計から除く
+    """
+    all_rows = np.arange(len(catalog))
+    hits = expected = 0
+    candidates = 0
+    exact_seconds = ann_seconds = 0.0
+    for user_vector in query_vectors:
+        started_at = time.perf_counter()
+        exact = _top_k_rows(catalog, user_vector, all_rows, k)
+        exact_seconds += time.perf_counter() - started_at
+
+        started_at = time.perf_counter()
+        probed = index.search(user_vector, n_probe)
+        approximate = _top_k_rows(catalog, user_vector, probed, k)
+        ann_seconds += time.perf_counter() - started_at
+        candidates += len(probed)
+
+        if len(exact) == 0:
+            continue
+        hits += len(np.intersect1d(exact, approximate))
+        expected += len(exact)
+
+    n_queries = len(query_vectors)
+    return {
+        "k": k,
+        "n_probe": n_probe,
+        "n_lists": index.n_lists,
+        "queries": n_queries,
+        "recall_at_k": hits / expected if expected else None,
+        "mean_candidates": candidates / n_queries if n_queries else 0,
+        "catalog_size": len(catalog),
+        "exact_ms_per_query": exact_seconds * 1000 / n_queries if n_queries else 0,
+        "ann_ms_per_query": ann_seconds * 1000 / n_queries if n_queries else 0,
+    }
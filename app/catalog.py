@@ -0,0 +1,365 @@
+"""
+レコメンド用のインメモリ商品カタログ
+products JOIN suppliers の結果を列指向のNumPy配列として保持し、
+リクエスト毎のDB全件スキャンを不要にする
+
+位置情報は仕入先が持つため、商品は仕入先順に並べ、仕入先から商品行への
+CSR形式のオフセット（supplier_offsets）で対応付ける。距離の判定は仕入先単位で1回だけ行う
+
+全件読み込みの後は updated_at のウォーターマーク以降に変更された行だけを取得し、
+配列を差分で組み直す（削除は件数の不一致から検出する）
+"""
+import hashlib
+import json
+import threading
+import time
+from dataclasses import dataclass, replace
+from functools import cached_property
+from typing import Any, Optional
+
+import numpy as np
+from sqlalchemy import text
+
+from app.geo import GridIndex
+from app.scoring import compact_preference_matrix, compute_row_norms
+
+# 嗜好スコアのカラム（PreferenceVectorのフィールド順と一致させる）
+PREFERENCE_KEYS = (
+    "heritage_soul", "modern_heirloom", "folk_heart", "fresh_folk",
+    "masterpiece", "innovative_classic", "craft_sense", "smart_craft",
+    "signature_mood", "iconic_style", "local_trend", "playful_pop",
+    "design_master", "global_trend", "smart_local", "smart_pick",
+)
+
+# 並び順はカタログ構築時に (仕入先, 商品) 順へ並べ替えるため、クエリでは指定しない
+CATALOG_COLUMNS = f"""
+        p.product_id, p.product_code, p.name AS product_name, p.description, p.image_url,
+        s.supplier_id, s.location,
+        {", ".join(f"p.{key}" for key in PREFERENCE_KEYS)}
+    FROM products p
+    JOIN suppliers s ON p.supplier_id = s.supplier_id
+"""
+CATALOG_QUERY = text(f"SELECT {CATALOG_COLUMNS}")
+
+# --- 差分更新用のクエリ ---
+WATERMARK_QUERY = text("""
+    SELECT
+        (SELECT MAX(updated_at) FROM products) AS products_updated_at,
+        (SELECT MAX(updated_at) FROM suppliers) AS suppliers_updated_at
+""")
+# updated_at は秒単位のため、同じ秒内の後続の更新を取りこぼさないよう >= で取得する
+# （境界の行は毎回再取得されるが、内容が同じ行は適用時に除外する）
+CHANGED_PRODUCTS_QUERY = text(f"SELECT {CATALOG_COLUMNS} WHERE p.updated_at >= :watermark")
+CHANGED_SUPPLIERS_QUERY = text("SELECT supplier_id, location FROM suppliers WHERE updated_at >= :watermark")
+PRODUCT_COUNT_QUERY = text("SELECT COUNT(*) FROM products p JOIN suppliers s ON p.supplier_id = s.supplier_id")
+PRODUCT_IDS_QUERY = text("SELECT p.product_id FROM products p JOIN suppliers s ON p.supplier_id = s.supplier_id")
+
+
+@dataclass(frozen=True)
+class ProductCatalog:
+    """商品カタログのスナップショット（読み取り専用として扱う）"""
+    version: int
+    loaded_at: float
+    watermark: Any               # 読み込み時点の updated_at の最大値（差分取得の起点）
+    product_ids: np.ndarray      # (n,) int64
+    product_codes: np.ndarray    # (n,) object
+    names: np.ndarray            # (n,) object
+    descriptions: np.ndarray     # (n,) object
+    image_urls: np.ndarray       # (n,) object
+    preferences: np.ndarray      # (n, 16) 値域に収まる最小の整数型（通常uint8）
+    preference_norms: np.ndarray # (n,) float64、preferences 各行のL2ノルム
+    product_id_order: np.ndarray # (n,) int64、product_ids を昇順に並べる行番号（id→行の検索用）
+    product_code_order: np.ndarray  # (n,) int64、product_codes を昇順に並べる行番号（コード→行の検索用）
+    product_suppliers: np.ndarray  # (n,) int32、各商品行の仕入先の位置
+    supplier_ids: np.ndarray     # (m,) int64
+    supplier_lat: np.ndarray     # (m,) float64、位置情報がない場合はNaN
+    supplier_lng: np.ndarray     # (m,) float64、位置情報がない場合はNaN
+    supplier_offsets: np.ndarray # (m + 1,) int64、仕入先 k の商品行は [offsets[k], offsets[k + 1])
+    spatial_index: GridIndex     # 仕入先の lat/lng のグリッドインデックス
+    scoring_version: str         # compute_scoring_version の値（事前計算したレコメンドとの照合用）
+    snapshot_name: Optional[str] = None  # 共有スナップショットから読み込んだ場合のスナップショット名
+
+    def __len__(self) -> int:
+        return len(self.product_ids)
+
+    def preference_dict(self, index: int) -> dict:
+        """指定行の嗜好スコアを PreferenceVector 用のdictとして返す"""
+        return dict(zip(PREFERENCE_KEYS, self.preferences[index].tolist()))
+
+    def product_location(self, index: int) -> Optional[dict]:
+        """指定行の商品の仕入先の位置を返す（位置情報がない場合はNone）"""
+        supplier = self.product_suppliers[index]
+        if np.isnan(self.supplier_lat[supplier]):
+            return None
+        return {"lat": float(self.supplier_lat[supplier]), "lng": float(self.supplier_lng[supplier])}
+
+    def supplier_product_rows(self, suppliers: np.ndarray):
+        """
+        仕入先の位置の配列から、その商品行を (行番号, 仕入先毎の商品数) として返す
+        行番号は仕入先の順に連結される
+        """
+        starts = self.supplier_offsets[suppliers]
+        counts = self.supplier_offsets[suppliers + 1] - starts
+        # 各仕入先の範囲 [start, start + count) を1回のarangeで展開する
+        shifts = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        return np.arange(counts.sum()) + shifts, counts
+
+    def rows_for_product_ids(self, product_ids) -> np.ndarray:
+        """product_id の配列に対応する行番号を返す（存在しないidは -1）"""
+        product_ids = np.asarray(product_ids, dtype=np.int64)
+        if len(self.product_ids) == 0:
+            return np.full(len(product_ids), -1, dtype=np.int64)
+        sorted_ids = self.product_ids[self.product_id_order]
+        positions = np.minimum(np.searchsorted(sorted_ids, product_ids), len(sorted_ids) - 1)
+        found = sorted_ids[positions] == product_ids
+        return np.where(found, self.product_id_order[positions], -1)
+
+    @cached_property
+    def content_version(self) -> str:
+        """
+        カタログの内容（scoring_version とウォーターマーク）から決まるバージョン
+        version はプロセス毎のカウンターのため、ETagなどプロセスの外に出す値にはこちらを使う
+        """
+        digest = hashlib.blake2b(digest_size=8)
+        digest.update(self.scoring_version.encode())
+        digest.update(str(self.watermark).encode())
+        return digest.hexdigest()
+
+    def rows_for_product_codes(self, product_codes) -> np.ndarray:
+        """product_code の並びに対応する行番号を返す（存在しないコードは -1）"""
+        product_codes = np.array(list(product_codes), dtype=object)
+        if len(self.product_codes) == 0 or len(product_codes) == 0:
+            return np.full(len(product_codes), -1, dtype=np.int64)
+        positions = np.searchsorted(self.product_codes, product_codes, sorter=self.product_code_order)
+        rows = self.product_code_order[np.minimum(positions, len(self.product_codes) - 1)]
+        found = self.product_codes[rows] == product_codes
+        return np.where(found, rows, -1)
+
+
+def compute_scoring_version(product_ids, preferences, product_suppliers, supplier_ids, supplier_lat, supplier_lng) -> str:
+    """
+    スコアと距離の計算に使う配列（商品のid・嗜好、仕入先のid・位置）から決まるバージョン
+    事前計算したレコメンドが現在のカタログで計算したものと同じになるかの判定に使う
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    for values in (product_ids, preferences, product_suppliers, supplier_ids, supplier_lat, supplier_lng):
+        digest.update(np.ascontiguousarray(values).tobytes())
+    return digest.hexdigest()
+
+
+def parse_location(location) -> Optional[dict]:
+    """suppliers.location（JSON文字列またはdict）から lat/lng を取り出す"""
+    if isinstance(location, str):
+        try:
+            location = json.loads(location)
+        except ValueError:
+            return None
+    if not location or 'lat' not in location or 'lng' not in location:
+        return None
+    return location
+
+
+def _location_pair(location):
+    location = parse_location(location)
+    if location is None:
+        return (np.nan, np.nan)
+    return (float(location['lat']), float(location['lng']))
+
+
+def _decode_rows(rows):
+    """
+    クエリ結果の行を列ごとの配列に変換する
+    仕入先の位置は {supplier_id: (lat, lng)} として仕入先毎に1回だけ解析する
+    """
+    n = len(rows)
+    columns = {
+        "product_ids": np.empty(n, dtype=np.int64),
+        "product_codes": np.empty(n, dtype=object),
+        "names": np.empty(n, dtype=object),
+        "descriptions": np.empty(n, dtype=object),
+        "image_urls": np.empty(n, dtype=object),
+        "preferences": np.zeros((n, len(PREFERENCE_KEYS)), dtype=np.int64),
+        "row_supplier_ids": np.empty(n, dtype=np.int64),
+    }
+    supplier_locations = {}
+    for i, row in enumerate(rows):
+        columns["product_ids"][i] = row.product_id
+        columns["product_codes"][i] = row.product_code
+        columns["names"][i] = row.product_name
+        columns["descriptions"][i] = row.description
+        columns["image_urls"][i] = row.image_url
+        columns["preferences"][i] = [getattr(row, key) or 0 for key in PREFERENCE_KEYS]
+        columns["row_supplier_ids"][i] = row.supplier_id
+        if row.supplier_id not in supplier_locations:
+            supplier_locations[row.supplier_id] = _location_pair(row.location)
+    columns["preference_norms"] = compute_row_norms(columns["preferences"])
+    return columns, supplier_locations
+
+
+def _assemble_catalog(columns: dict, supplier_locations: dict, version: int, watermark) -> ProductCatalog:
+    """商品の列配列を (仕入先, 商品) 順に並べ替え、仕入先のCSRオフセットと索引を付けてカタログにする"""
+    order = np.lexsort((columns["product_ids"], columns["row_supplier_ids"]))
+    columns = {name: values[order] for name, values in columns.items()}
+    supplier_ids, offsets, product_suppliers = np.unique(
+        columns["row_supplier_ids"], return_index=True, return_inverse=True
+    )
+    locations = [supplier_locations[supplier_id] for supplier_id in supplier_ids.tolist()]
+    supplier_lat = np.array([lat for lat, _ in locations], dtype=np.float64)
+    supplier_lng = np.array([lng for _, lng in locations], dtype=np.float64)
+    # 検索用の索引・バージョンはリクエストの処理中ではなく、ここ（更新のスレッド）で求める
+    preferences = compact_preference_matrix(columns["preferences"])
+    product_suppliers = product_suppliers.reshape(-1).astype(np.int32)
+    supplier_ids = supplier_ids.astype(np.int64)
+    return ProductCatalog(
+        version=version,
+        loaded_at=time.time(),
+        watermark=watermark,
+        product_ids=columns["product_ids"],
+        product_codes=columns["product_codes"],
+        names=columns["names"],
+        descriptions=columns["descriptions"],
+        image_urls=columns["image_urls"],
+        preferences=preferences,
+        preference_norms=columns["preference_norms"],
+        product_id_order=np.argsort(columns["product_ids"], kind="stable"),
+        product_code_order=np.argsort(columns["product_codes"], kind="stable").astype(np.int64),
+        product_suppliers=product_suppliers,
+        supplier_ids=supplier_ids,
+        supplier_lat=supplier_lat,
+        supplier_lng=supplier_lng,
+        supplier_offsets=np.append(offsets, len(order)).astype(np.int64),
+        spatial_index=GridIndex(supplier_lat, supplier_lng),
+        scoring_version=compute_scoring_version(
+            columns["product_ids"], preferences, product_suppliers, supplier_ids, supplier_lat, supplier_lng
+        ),
+    )
+
+
+def build_catalog(rows, version: int, watermark=None) -> ProductCatalog:
+    """CATALOG_QUERY の結果行から列指向のカタログを組み立てる"""
+    columns, supplier_locations = _decode_rows(rows)
+    return _assemble_catalog(columns, supplier_locations, version, watermark)
+
+
+def _same_row(catalog: ProductCatalog, index: int, columns: dict, j: int) -> bool:
+    return (
+        catalog.supplier_ids[catalog.product_suppliers[index]] == columns["row_supplier_ids"][j]
+        and catalog.product_codes[index] == columns["product_codes"][j]
+        and catalog.names[index] == columns["names"][j]
+        and catalog.descriptions[index] == columns["descriptions"][j]
+        and catalog.image_urls[index] == columns["image_urls"][j]
+        and np.array_equal(catalog.preferences[index], columns["preferences"][j])
+    )
+
+
+def apply_delta(catalog: ProductCatalog, changed_rows, changed_suppliers, deleted_ids, watermark) -> Optional[ProductCatalog]:
+    """
+    変更された商品行・仕入先の行と削除された商品idを反映した新しいカタログを返す
+    既存の配列は書き換えず、変更のない行の配列とノルムを再利用して組み直す
+    内容に変化がない場合はNoneを返す（バージョンを進めず、レコメンドキャッシュを維持する）
+    """
+    changed, changed_locations = _decode_rows(changed_rows)
+    for row in changed_suppliers:
+        changed_locations[row.supplier_id] = _location_pair(row.location)
+
+    existing = catalog.rows_for_product_ids(changed["product_ids"])
+    modified = np.array([
+        index < 0 or not _same_row(catalog, index, changed, j) for j, index in enumerate(existing.tolist())
+    ], dtype=bool)
+
+    supplier_locations = dict(zip(catalog.supplier_ids.tolist(), zip(catalog.supplier_lat.tolist(), catalog.supplier_lng.tolist())))
+    relocated = any(
+        supplier_id in supplier_locations
+        and not np.array_equal(supplier_locations[supplier_id], location, equal_nan=True)
+        for supplier_id, location in changed_locations.items()
+    )
+    supplier_locations.update(changed_locations)
+
+    deleted_ids = np.asarray(deleted_ids, dtype=np.int64)
+    if not modified.any() and not relocated and len(deleted_ids) == 0:
+        return None
+
+    upserts = {name: values[modified] for name, values in changed.items()}
+    keep = ~np.isin(catalog.product_ids, np.concatenate([upserts["product_ids"], deleted_ids]))
+    current = {
+        "product_ids": catalog.product_ids,
+        "product_codes": catalog.product_codes,
+        "names": catalog.names,
+        "descriptions": catalog.descriptions,
+        "image_urls": catalog.image_urls,
+        "preferences": catalog.preferences,
+        "preference_norms": catalog.preference_norms,
+        "row_supplier_ids": catalog.supplier_ids[catalog.product_suppliers],
+    }
+    columns = {name: np.concatenate([values[keep], upserts[name]]) for name, values in current.items()}
+    return _assemble_catalog(columns, supplier_locations, catalog.version + 1, watermark)
+
+
+def read_watermark(db):
+    """products/suppliers の updated_at の最大値を返す（行がなければNone）"""
+    row = db.execute(WATERMARK_QUERY).first()
+    values = [value for value in (row.products_updated_at, row.suppliers_updated_at) if value is not None]
+    return max(values) if values else None
+
+
+# --- プロセス全体で共有するカタログ ---
+_catalog: Optional[ProductCatalog] = None
+_refresh_lock = threading.Lock()
+
+
+def get_catalog() -> Optional[ProductCatalog]:
+    """現在のカタログを返す（未ロードの場合はNone）"""
+    return _catalog
+
+
+def refresh_catalog(db) -> ProductCatalog:
+    """DBからカタログを再構築し、参照の差し替えでアトミックに入れ替える"""
+    global _catalog
+    with _refresh_lock:
+        # 読み込み中に更新された行を次回の差分で拾えるよう、ウォーターマークを先に取得する
+        watermark = read_watermark(db)
+        rows = db.execute(CATALOG_QUERY).fetchall()
+        version = _catalog.version + 1 if _catalog is not None else 1
+        catalog = build_catalog(rows, version, watermark)
+        _catalog = catalog
+    return catalog
+
+
+def refresh_catalog_delta(db) -> Optional[ProductCatalog]:
+    """
+    ウォーターマーク以降に変更された行だけを取得してカタログを差分更新する
+    削除は件数の不一致を検出した場合のみ全idを突き合わせて求める
+    変更がなかった場合はNoneを返す（カタログ未ロードの場合もNone）
+    """
+    global _catalog
+    with _refresh_lock:
+        current = _catalog
+        if current is None or current.watermark is None:
+            return None
+        watermark = read_watermark(db)
+        params = {"watermark": current.watermark}
+        changed_rows = db.execute(CHANGED_PRODUCTS_QUERY, params).fetchall()
+        changed_suppliers = db.execute(CHANGED_SUPPLIERS_QUERY, params).fetchall()
+
+        changed_ids = np.array([row.product_id for row in changed_rows], dtype=np.int64)
+        added = np.count_nonzero(current.rows_for_product_ids(changed_ids) < 0)
+        deleted_ids = []
+        if db.execute(PRODUCT_COUNT_QUERY).scalar() != len(current) + added:
+            db_ids = np.array([row.product_id for row in db.execute(PRODUCT_IDS_QUERY)], dtype=np.int64)
+            deleted_ids = current.product_ids[~np.isin(current.product_ids, db_ids)]
+
+        catalog = apply_delta(current, changed_rows, changed_suppliers, deleted_ids, watermark)
+        if catalog is None:
+            # 内容に変化がなくてもウォーターマークは進める（索引などのフィールドはそのまま引き継ぐ）
+            if watermark != current.watermark:
+                _catalog = replace(current, watermark=watermark)
+            return None
+        _catalog = catalog
+    return catalog
+
+
+def install_catalog(catalog: ProductCatalog):
+    """別の経路で構築したカタログ（共有スナップショット等）に差し替える"""
+    global _catalog
+    with _refresh_lock:
+        _catalog = catalog
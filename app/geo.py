@@ -0,0 +1,101 @@
+"""
+位置情報の計算ユーティリティ
+"""
+import math
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371
+
+
+def haversine_distance(lat1, lon1, lat2, lon2):
+    """2点間の距離(km)をスカラーで計算する（ベクトル版の検証用リファレンス）"""
+    R = EARTH_RADIUS_KM
+    d_lat = math.radians(lat2 - lat1)
+    d_lon = math.radians(lon2 - lon1)
+    a = (math.sin(d_lat / 2) ** 2 +
+         math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) *
+         math.sin(d_lon / 2) ** 2)
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    return R * c
+
+
+def haversine_distances(lat: float, lng: float, lats: np.ndarray, lngs: np.ndarray) -> np.ndarray:
+    """1点から座標配列の各点までの距離(km)を一括で計算する（NaNの座標はNaNを返す）"""
+    d_lat = np.radians(lats - lat)
+    d_lng = np.radians(lngs - lng)
+    a = (np.sin(d_lat / 2) ** 2 +
+         math.cos(math.radians(lat)) * np.cos(np.radians(lats)) *
+         np.sin(d_lng / 2) ** 2)
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return EARTH_RADIUS_KM * c
+
+
+def bounding_box(lat: float, lng: float, radius_km: float):
+    """
+    中心から半径 radius_km の円を囲む緯度経度の範囲を返す
+    戻り値: (min_lat, max_lat, min_lng, max_lng)
+    極や日付変更線をまたぐ場合は経度方向を全範囲とする
+    """
+    angular = radius_km / EARTH_RADIUS_KM
+    d_lat = math.degrees(angular)
+    min_lat, max_lat = lat - d_lat, lat + d_lat
+    if min_lat <= -90 or max_lat >= 90:
+        return max(min_lat, -90.0), min(max_lat, 90.0), -180.0, 180.0
+
+    d_lng = math.degrees(math.asin(min(1.0, math.sin(angular) / math.cos(math.radians(lat)))))
+    min_lng, max_lng = lng - d_lng, lng + d_lng
+    if min_lng < -180 or max_lng > 180:
+        return min_lat, max_lat, -180.0, 180.0
+    return min_lat, max_lat, min_lng, max_lng
+
+
+class GridIndex:
+    """
+    緯度経度の固定グリッドによる空間インデックス
+    各セルに属する行番号を連続した範囲として保持し、半径検索の候補行を絞り込む
+    """
+
+    def __init__(self, lats: np.ndarray, lngs: np.ndarray, cell_deg: float = 0.1):
+        self.cell_deg = cell_deg
+        valid = np.flatnonzero(~np.isnan(lats) & ~np.isnan(lngs))
+        cell_rows = np.floor(lats[valid] / cell_deg).astype(np.int64)
+        cell_cols = np.floor(lngs[valid] / cell_deg).astype(np.int64)
+
+        # セル順に並べ替え、セル毎の [start, end) 範囲を記録する
+        order = np.lexsort((cell_cols, cell_rows))
+        self._rows = valid[order]
+        cell_rows = cell_rows[order]
+        cell_cols = cell_cols[order]
+        boundaries = np.flatnonzero((np.diff(cell_rows) != 0) | (np.diff(cell_cols) != 0)) + 1
+        starts = np.concatenate(([0], boundaries)) if len(order) else np.empty(0, dtype=np.int64)
+        ends = np.append(starts[1:], len(order))
+        self._cells = {
+            (int(cell_rows[start]), int(cell_cols[start])): (int(start), int(end))
+            for start, end in zip(starts, ends)
+        }
+
+    def query_radius(self, lat: float, lng: float, radius_km: float) -> np.ndarray:
+        """半径 radius_km の円を覆うセルに含まれる行番号を昇順で返す（距離の判定は呼び出し側で行う）"""
+        min_lat, max_lat, min_lng, max_lng = bounding_box(lat, lng, radius_km)
+        row_range = (math.floor(min_lat / self.cell_deg), math.floor(max_lat / self.cell_deg))
+        col_range = (math.floor(min_lng / self.cell_deg), math.floor(max_lng / self.cell_deg))
+
+        n_covering = (row_range[1] - row_range[0] + 1) * (col_range[1] - col_range[0] + 1)
+        if n_covering > len(self._cells):
+            # 覆うセル数が多い場合は存在するセルを走査した方が速い
+            ranges = [
+                span for (row, col), span in self._cells.items()
+                if row_range[0] <= row <= row_range[1] and col_range[0] <= col <= col_range[1]
+            ]
+        else:
+            ranges = [
+                self._cells[(row, col)]
+                for row in range(row_range[0], row_range[1] + 1)
+                for col in range(col_range[0], col_range[1] + 1)
+                if (row, col) in self._cells
+            ]
+
+        if not ranges:
+            return np.empty(0, dtype=np.int64)
+        return np.sort(np.concatenate([self._rows[start:end] for start, end in ranges]))
@@ -1,16 +1,31 @@
 import os
-import json
-import math
+import time
+import asyncio
 import numpy as np
+import orjson
 import traceback 
+from contextlib import asynccontextmanager
 from datetime import datetime
-from fastapi import FastAPI, HTTPException, Depends, Form
+from fastapi import FastAPI, HTTPException, Depends, Form, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import create_engine, text
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy import create_engine, text, bindparam
 from sqlalchemy.orm import sessionmaker, Session
 from pydantic import BaseModel, Field
-from typing import List, Optional, Annotated
+from typing import List, Literal, Optional, Annotated, Union
 from dotenv import load_dotenv
+from app.ann import get_ivf_index, refresh_ivf_index
+from app.catalog import PREFERENCE_KEYS, get_catalog, refresh_catalog, refresh_catalog_delta
+from app.geo import bounding_box, haversine_distance, haversine_distances
+from app.precomputed import DEFAULT_CELL_DEG, hotspot_cell, lookup_precomputed
+from app.pagination import after_cursor_mask, decode_cursor, encode_cursor, top_k_indices
+from app.rec_cache import RecommendationCache, location_cell
+from app.scoring import MIN_MATCH_PERCENTAGE, RECOMMENDATION_RADIUS_KM, cosine_match_percentage_matrix, cosine_match_percentages
+from app.scoring_pool import ScoringPool
+from app.selection import PayloadPool, build_selection, build_selection_payload, resolve_item_preferences, selection_ids_exist
+from app.shared_catalog import acquire_publisher_lock, attach_shared_catalog, publish_catalog
+from app.timing import ServerTimingMiddleware, StageHistograms, mark_handler_done, stage
 
 # 環境変数を読み込み（.envファイルが存在する場合のみ）
 try:
@@ -47,7 +62,181 @@ DATABASE_URL = get_database_url()
 connect_args = {"check_same_thread": False} if "sqlite" in DATABASE_URL else {}
 engine = create_engine(DATABASE_URL, connect_args=connect_args, pool_pre_ping=True)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-app = FastAPI()
+
+# レコメンドをストリーミングで返す場合のメディアタイプ（Acceptヘッダーで指定）
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+# バッチレコメンドで1回の行列積にまとめるクエリのセルの大きさ（度）。近いクエリほど周辺商品が重なる
+BATCH_GROUP_CELL_DEG = float(os.getenv('BATCH_GROUP_CELL_DEG', '0.05'))
+# バッチレコメンドの1回の行列積の上限（周辺商品の和集合の行数 × ユーザー数）
+BATCH_SCORE_BLOCK = int(os.getenv('BATCH_SCORE_BLOCK', '2000000'))
+
+# --- レコメンド結果キャッシュ設定 ---
+# RECOMMENDATION_CACHE_SIZE=0 でキャッシュを無効化する
+RECOMMENDATION_CACHE_CELL_DEG = float(os.getenv('RECOMMENDATION_CACHE_CELL_DEG', '0.001'))
+recommendation_cache = RecommendationCache(
+    maxsize=int(os.getenv('RECOMMENDATION_CACHE_SIZE', '10000')),
+    ttl=float(os.getenv('RECOMMENDATION_CACHE_TTL', '60')),
+)
+
+# --- 事前計算レコメンド設定 ---
+# precompute_recommendations.py がホットスポットのセル毎に計算した結果を、先頭ページのリクエストで使う
+PRECOMPUTED_ENABLED = os.getenv('PRECOMPUTED_ENABLED', 'true').lower() == 'true'
+# precompute_recommendations.py と同じ値にすること
+PRECOMPUTED_CELL_DEG = float(os.getenv('PRECOMPUTED_CELL_DEG', str(DEFAULT_CELL_DEG)))
+
+# --- 嗜好選択の事前生成設定 ---
+# /preferences/selection のレスポンスをバックグラウンドで生成してためておく件数（0で無効）
+SELECTION_POOL_SIZE = int(os.getenv('SELECTION_POOL_SIZE', '256'))
+SELECTION_POOL_REFILL_INTERVAL = float(os.getenv('SELECTION_POOL_REFILL_INTERVAL', '0.5'))
+# カタログ更新後も、削除された仕入先・商品を含まない限り古いレスポンスを返し続ける時間（秒）
+SELECTION_POOL_MAX_AGE = float(os.getenv('SELECTION_POOL_MAX_AGE', '60'))
+selection_pool = PayloadPool(SELECTION_POOL_SIZE, SELECTION_POOL_MAX_AGE)
+# seed指定時はseedをこの数のバケットに丸め、(カタログの内容, バケット) 毎に同じ選択肢を返す（0以下でseedを無視する）
+SELECTION_SEED_BUCKETS = int(os.getenv('SELECTION_SEED_BUCKETS', '1024'))
+# seed指定時のレスポンスのCache-Control（秒）
+SELECTION_SEED_MAX_AGE = int(os.getenv('SELECTION_SEED_MAX_AGE', '300'))
+seeded_selection_cache = RecommendationCache(maxsize=max(SELECTION_SEED_BUCKETS, 0), ttl=SELECTION_SEED_MAX_AGE)
+
+# --- 全国レコメンド（ANN）設定 ---
+# 検索時に調べるクラスタ数。大きくすると再現率が上がり、速度は下がる
+ANN_N_PROBE = int(os.getenv('ANN_N_PROBE', '8'))
+# クラスタ数（0の場合は商品数の平方根）
+ANN_N_LISTS = int(os.getenv('ANN_N_LISTS', '0'))
+# インデックスの再構築の最短間隔（秒）。それまでは前のインデックスを現在のカタログに引き直して使う
+ANN_REBUILD_INTERVAL = int(os.getenv('ANN_REBUILD_INTERVAL', '300'))
+
+# --- 商品カタログ設定 ---
+# CATALOG_ENABLED=false の場合は従来通りリクエスト毎にDBを参照する
+CATALOG_ENABLED = os.getenv('CATALOG_ENABLED', 'true').lower() == 'true'
+# 全件の再読み込みの間隔（差分更新の取りこぼしに対する保険）
+CATALOG_REFRESH_INTERVAL = int(os.getenv('CATALOG_REFRESH_INTERVAL', '3600'))
+# updated_at が進んだ行だけを取り込む差分更新の間隔（0の場合は全件の再読み込みのみ）
+CATALOG_DELTA_INTERVAL = int(os.getenv('CATALOG_DELTA_INTERVAL', '5'))
+# CATALOG_SHARED_DIR を設定すると、gunicornの全ワーカーでカタログのスナップショットを共有する
+# DBからの再構築は1ワーカーだけが行い、他のワーカーはCATALOG_SHARED_POLL_INTERVAL毎に切り替えを確認する
+CATALOG_SHARED_DIR = os.getenv('CATALOG_SHARED_DIR', '')
+CATALOG_SHARED_POLL_INTERVAL = int(os.getenv('CATALOG_SHARED_POLL_INTERVAL', '5'))
+# SCORING_WORKERS > 0 の場合、/recommendations のスコアリングを共有カタログを参照するプロセスプールで行う
+# （CATALOG_SHARED_DIR が必要。プロセス数はgunicornのワーカー毎に SCORING_WORKERS 個）
+SCORING_WORKERS = int(os.getenv('SCORING_WORKERS', '0'))
+scoring_pool: Optional[ScoringPool] = None
+# 前回の全件読み込み・差分更新の時刻（共有モードではポーリング間隔とは別にこれらで間隔を判定する）
+# （time.monotonic() の起点は不定のため、未実施は -inf で表す）
+_last_catalog_refresh = float("-inf")
+_last_catalog_delta = float("-inf")
+
+def refresh_product_catalog(full: bool = True):
+    """商品カタログをDBから再読み込みする（full=Falseは差分更新。失敗時は現在のカタログを維持）"""
+    global _last_catalog_refresh, _last_catalog_delta
+    db = SessionLocal()
+    try:
+        if full:
+            catalog = refresh_catalog(db)
+            _last_catalog_refresh = _last_catalog_delta = time.monotonic()
+        else:
+            catalog = refresh_catalog_delta(db)
+            _last_catalog_delta = time.monotonic()
+            if catalog is None:
+                return
+        if CATALOG_SHARED_DIR:
+            publish_catalog(catalog, CATALOG_SHARED_DIR)
+            # 自身もメモリマップ版に切り替え、プロセス固有の配列を解放する
+            attach_shared_catalog(CATALOG_SHARED_DIR)
+        print(f"商品カタログを読み込みました: version={catalog.version}, products={len(catalog)}")
+    except Exception as e:
+        print(f"商品カタログの読み込みに失敗しました: {e}")
+    finally:
+        db.close()
+
+def sync_product_catalog():
+    """カタログを最新に保つ（共有モードでは再構築担当のワーカー以外は公開済みスナップショットを参照する）"""
+    if not CATALOG_SHARED_DIR:
+        full = catalog_refresh_kind()
+        if full is not None:
+            refresh_product_catalog(full=full)
+        return
+    try:
+        if not acquire_publisher_lock(CATALOG_SHARED_DIR):
+            catalog = attach_shared_catalog(CATALOG_SHARED_DIR)
+            if catalog is not None:
+                print(f"共有カタログに切り替えました: version={catalog.version}, products={len(catalog)}")
+            return
+        if get_catalog() is None:
+            # 再起動時は既存のスナップショットから引き継ぎ、バージョンを連続させる
+            try:
+                attach_shared_catalog(CATALOG_SHARED_DIR)
+            except Exception as e:
+                # 形式の古いスナップショットなど。全件読み込みで公開し直す
+                print(f"既存の共有カタログを読み込めませんでした: {e}")
+    except Exception as e:
+        print(f"共有カタログの参照に失敗しました: {e}")
+        return
+    full = catalog_refresh_kind()
+    if full is not None:
+        refresh_product_catalog(full=full)
+
+def catalog_refresh_kind() -> Optional[bool]:
+    """
+    今回の再読み込みの種類を返す（True: 全件、False: 差分、None: まだ不要）
+    全件は未ロードか前回から CATALOG_REFRESH_INTERVAL 経過時、差分は前回から CATALOG_DELTA_INTERVAL 経過時に行う
+    （差分更新が無効の場合は CATALOG_REFRESH_INTERVAL 毎の全件読み込みだけになる）
+    """
+    now = time.monotonic()
+    if get_catalog() is None or now - _last_catalog_refresh >= CATALOG_REFRESH_INTERVAL:
+        return True
+    if CATALOG_DELTA_INTERVAL > 0 and now - _last_catalog_delta >= CATALOG_DELTA_INTERVAL:
+        return False
+    return None
+
+def rebuild_ann_index():
+    """全国レコメンドのANNインデックスをカタログ更新のスレッドで再構築する（構築中は前のインデックスで検索を続ける）"""
+    try:
+        started_at = time.perf_counter()
+        if refresh_ivf_index(get_catalog(), ANN_N_LISTS or None, ANN_REBUILD_INTERVAL):
+            print(f"ANNインデックスを再構築しました: {time.perf_counter() - started_at:.1f} 秒")
+    except Exception as e:
+        print(f"ANNインデックスの再構築に失敗しました: {e}")
+
+async def periodic_catalog_refresh(interval: int):
+    while True:
+        await asyncio.sleep(interval)
+        await asyncio.to_thread(sync_product_catalog)
+        await asyncio.to_thread(rebuild_ann_index)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global scoring_pool
+    refresh_task = None
+    refill_task = None
+    if CATALOG_ENABLED:
+        await asyncio.to_thread(sync_product_catalog)
+        await asyncio.to_thread(rebuild_ann_index)
+        if CATALOG_SHARED_DIR:
+            interval = CATALOG_SHARED_POLL_INTERVAL
+        else:
+            interval = CATALOG_DELTA_INTERVAL if CATALOG_DELTA_INTERVAL > 0 else CATALOG_REFRESH_INTERVAL
+        if interval > 0:
+            refresh_task = asyncio.create_task(periodic_catalog_refresh(interval))
+        if SCORING_WORKERS > 0:
+            if CATALOG_SHARED_DIR:
+                scoring_pool = ScoringPool(SCORING_WORKERS, CATALOG_SHARED_DIR)
+            else:
+                print("SCORING_WORKERS にはCATALOG_SHARED_DIR の設定が必要です。スコアリングはAPIプロセスで行います")
+        if SELECTION_POOL_SIZE > 0:
+            refill_task = asyncio.create_task(periodic_selection_refill(SELECTION_POOL_REFILL_INTERVAL))
+    yield
+    if refresh_task:
+        refresh_task.cancel()
+    if refill_task:
+        refill_task.cancel()
+    if scoring_pool:
+        scoring_pool.shutdown()
+        scoring_pool = None
+
+# orjsonでシリアライズする
+# dictを返すハンドラーはjsonable_encoderを通るため、NumPyの値はそのままでは返せない
+# NumPyのスカラー・配列を含むレスポンスはハンドラー内で ORJSONResponse(...) を直接返すこと
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # --- CORS設定 ---
 app.add_middleware(
@@ -56,8 +245,15 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # NDJSONのストリーミングでは次ページのカーソルをヘッダーで返す
+    expose_headers=["X-Next-Cursor"],
 )
 
+# --- 処理段階の計測 ---
+# レコメンド系エンドポイントの段階別の所要時間をServer-Timingヘッダーで返し、ヒストグラムに集計する
+stage_histograms = StageHistograms()
+app.add_middleware(ServerTimingMiddleware, histograms=stage_histograms, path_prefix="/recommendations")
+
 # --- DBセッション ---
 def get_db():
     db = SessionLocal()
@@ -67,6 +263,8 @@ def get_db():
         db.close()
 
 # --- Pydanticモデル定義 ---
+# 選択肢・レコメンドのレスポンスは自前のDB・カタログの値からdictで組み立て、ORJSONResponseで直接返す
+# （アイテム毎のモデル生成と response_model による再検証を省く。response_model はドキュメント用）
 class PreferenceVector(BaseModel):
     heritage_soul: int = 0; modern_heirloom: int = 0; folk_heart: int = 0; fresh_folk: int = 0; masterpiece: int = 0; innovative_classic: int = 0; craft_sense: int = 0; smart_craft: int = 0; signature_mood: int = 0; iconic_style: int = 0; local_trend: int = 0; playful_pop: int = 0; design_master: int = 0; global_trend: int = 0; smart_local: int = 0; smart_pick: int = 0
 
@@ -90,6 +288,10 @@ class ProfileSetupRequest(BaseModel):
 class PreferenceRequest(BaseModel):
     user_id: int; shown_items: List[Item]; selected_ids: List[str]
 
+class PreferenceIdsRequest(BaseModel):
+    """表示したidと選択したidだけを送る形式（嗜好ベクトルはサーバー側で解決する）"""
+    user_id: int; shown_ids: List[str]; selected_ids: List[str]
+
 class Token(BaseModel):
     access_token: str; token_type: str; email: str; user_id: int
 
@@ -108,6 +310,24 @@ class SelectionResponse(BaseModel):
 
 class RecommendationResponse(BaseModel):
     items: List[RecommendationItem]
+    next_cursor: Optional[str] = None
+
+class BatchRecommendationQuery(BaseModel):
+    user_id: int
+    latitude: float
+    longitude: float
+
+class BatchRecommendationRequest(BaseModel):
+    queries: List[BatchRecommendationQuery] = Field(..., min_length=1, max_length=1000)
+    limit: int = Field(20, ge=1, le=500)
+
+class BatchRecommendationResult(BatchRecommendationQuery):
+    items: List[RecommendationItem] = []
+    next_cursor: Optional[str] = None
+    error: Optional[str] = None
+
+class BatchRecommendationResponse(BaseModel):
+    results: List[BatchRecommendationResult]
 
 class FavoriteRequest(BaseModel):
     user_id: int
@@ -118,33 +338,29 @@ class DestinatedRequest(BaseModel):
     item_id: str
 
 # --- ヘルパー関数 ---
-def haversine_distance(lat1, lon1, lat2, lon2):
-    R = 6371
-    d_lat = math.radians(lat2 - lat1)
-    d_lon = math.radians(lon2 - lon1)
-    a = (math.sin(d_lat / 2) ** 2 +
-         math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) *
-         math.sin(d_lon / 2) ** 2)
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return R * c
-
-def calculate_preference_vector(shown_items: List[Item], selected_ids: List[str]) -> dict:
-    user_vector = np.zeros(16)
+def preference_vector_from_matrix(item_matrix: np.ndarray, selected_mask: np.ndarray) -> dict:
+    """表示したアイテムの嗜好行列から、選択したものを加算・選択しなかったものを0.2倍で減算して正規化する"""
     preference_keys = PreferenceVector.model_fields.keys()
-    selected_ids_set = set(selected_ids)
+    user_vector = np.where(selected_mask, 1.0, -0.2) @ item_matrix if len(item_matrix) else np.zeros(16)
 
-    for item in shown_items:
-        item_vector = np.array([getattr(item.preferences, key) for key in preference_keys])
-        if item.id in selected_ids_set:
-            user_vector += item_vector
-        else:
-            user_vector -= (item_vector * 0.2)
-    
     max_score = user_vector.max()
     final_vector = np.zeros(16, dtype=int) if max_score <= 0 else np.round((user_vector / max_score) * 100).astype(int)
     
-    final_scores_dict = dict(zip(preference_keys, final_vector))
-    return {key: int(value) for key, value in final_scores_dict.items()}
+    # tolist() でPythonのintになるため、そのままSQLのパラメータに使える
+    return dict(zip(preference_keys, final_vector.tolist()))
+
+def calculate_preference_vector(shown_items: List[Item], selected_ids: List[str]) -> dict:
+    preference_keys = PreferenceVector.model_fields.keys()
+    item_matrix = np.array([[getattr(item.preferences, key) for key in preference_keys] for item in shown_items], dtype=np.float64)
+    selected_mask = np.isin([item.id for item in shown_items], selected_ids)
+    return preference_vector_from_matrix(item_matrix, selected_mask)
+
+def calculate_preference_vector_from_ids(db: Session, shown_ids: List[str], selected_ids: List[str]) -> dict:
+    """idだけのペイロードから嗜好ベクトルを計算する（見つからないidは表示しなかったものとして扱う）"""
+    catalog = get_catalog() if CATALOG_ENABLED else None
+    item_matrix, found = resolve_item_preferences(db, catalog, shown_ids)
+    selected_mask = np.isin(shown_ids, selected_ids) & found
+    return preference_vector_from_matrix(item_matrix, selected_mask)
 
 # --- APIエンドポイント定義 ---
 @app.post("/users/register")
@@ -194,78 +410,105 @@ def setup_user_profile(request: ProfileSetupRequest, db: Session = Depends(get_d
             db.rollback(); raise HTTPException(status_code=500, detail=str(e))
     raise HTTPException(status_code=400, detail="user_id or guest_id must be provided")
 
+def refill_selection_pool():
+    """選択肢のレスポンスをシリアライズしてプールに補充する（カタログ未ロード時は何もしない）"""
+    catalog = get_catalog() if CATALOG_ENABLED else None
+    missing = selection_pool.missing()
+    if catalog is None or missing <= 0:
+        return
+    db = SessionLocal()
+    try:
+        for _ in range(missing):
+            payload, supplier_ids, product_ids = build_selection(db, catalog)
+            selection_pool.push(catalog.version, orjson.dumps(payload), (supplier_ids, product_ids))
+    except Exception as e:
+        print(f"選択肢の補充に失敗しました: {e}")
+    finally:
+        db.close()
+
+async def periodic_selection_refill(interval: float):
+    while True:
+        await asyncio.to_thread(refill_selection_pool)
+        await asyncio.sleep(interval)
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """If-None-Match と弱い比較で照合する（RFC 9110。W/ を除いたタグ同士を比べる）"""
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*":
+        return True
+    return etag.removeprefix("W/") in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+
+def seeded_selection_response(request: Request, db: Session, catalog, bucket: int) -> Response:
+    """
+    バケットとカタログの内容から決まる選択肢を、ETag・Cache-Control付きで返す
+    （プロセス毎の catalog.version ではなく content_version を使い、ワーカーや再起動が違っても同じ値にする）
+    """
+    content_version = catalog.content_version
+    etag = f'"selection-{content_version}-{bucket}"'
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={SELECTION_SEED_MAX_AGE}"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    key = (content_version, bucket)
+    payload = seeded_selection_cache.get(key)
+    if payload is None:
+        rng = np.random.default_rng([int(content_version, 16), bucket])
+        payload = orjson.dumps(build_selection_payload(db, catalog, rng=rng))
+        seeded_selection_cache.put(key, payload)
+    return Response(content=payload, media_type="application/json", headers=headers)
+
+def adaptive_selection_response(db: Session, catalog, user_id: Optional[int]):
+    """嗜好の次元を広く覆う商品を選ぶ（user_idがあれば、そのユーザーの現在のベクトルで説明できない方向を優先する）"""
+    user_vector = None
+    if user_id is not None:
+        user_result = db.execute(text(f"SELECT {', '.join(PREFERENCE_KEYS)} FROM users WHERE user_id = :uid"), {"uid": user_id}).first()
+        if not user_result:
+            raise HTTPException(status_code=404, detail="User not found")
+        user_vector = [value or 0 for value in user_result]
+    return ORJSONResponse(build_selection_payload(db, catalog, adaptive=True, user_vector=user_vector))
+
 @app.get("/preferences/selection", response_model=SelectionResponse)
-def get_items_for_selection(db: Session = Depends(get_db)):
-    supplier_query = text("SELECT supplier_id, name, description, image_url, heritage_soul, modern_heirloom, folk_heart, fresh_folk, masterpiece, innovative_classic, craft_sense, smart_craft, signature_mood, iconic_style, local_trend, playful_pop, design_master, global_trend, smart_local, smart_pick FROM suppliers ORDER BY RAND() LIMIT 3")
-    suppliers_result = db.execute(supplier_query).fetchall()
-    product_query = text("SELECT product_code, name, description, image_url, heritage_soul, modern_heirloom, folk_heart, fresh_folk, masterpiece, innovative_classic, craft_sense, smart_craft, signature_mood, iconic_style, local_trend, playful_pop, design_master, global_trend, smart_local, smart_pick FROM products ORDER BY RAND() LIMIT 3")
-    products_result = db.execute(product_query).fetchall()
-    # Suppliersの変換（_mappingの代わりに個別のカラムを指定）
-    suppliers = []
-    for row in suppliers_result:
-        pref_dict = {
-            'heritage_soul': row.heritage_soul or 0,
-            'modern_heirloom': row.modern_heirloom or 0,
-            'folk_heart': row.folk_heart or 0,
-            'fresh_folk': row.fresh_folk or 0,
-            'masterpiece': row.masterpiece or 0,
-            'innovative_classic': row.innovative_classic or 0,
-            'craft_sense': row.craft_sense or 0,
-            'smart_craft': row.smart_craft or 0,
-            'signature_mood': row.signature_mood or 0,
-            'iconic_style': row.iconic_style or 0,
-            'local_trend': row.local_trend or 0,
-            'playful_pop': row.playful_pop or 0,
-            'design_master': row.design_master or 0,
-            'global_trend': row.global_trend or 0,
-            'smart_local': row.smart_local or 0,
-            'smart_pick': row.smart_pick or 0
-        }
-        suppliers.append(Item(
-            id=f"s{row.supplier_id}",
-            name=row.name,
-            description=row.description,
-            image_url=row.image_url,
-            preferences=PreferenceVector(**pref_dict)
-        ))
-    
-    # Productsの変換（_mappingの代わりに個別のカラムを指定）
-    products = []
-    for row in products_result:
-        pref_dict = {
-            'heritage_soul': row.heritage_soul or 0,
-            'modern_heirloom': row.modern_heirloom or 0,
-            'folk_heart': row.folk_heart or 0,
-            'fresh_folk': row.fresh_folk or 0,
-            'masterpiece': row.masterpiece or 0,
-            'innovative_classic': row.innovative_classic or 0,
-            'craft_sense': row.craft_sense or 0,
-            'smart_craft': row.smart_craft or 0,
-            'signature_mood': row.signature_mood or 0,
-            'iconic_style': row.iconic_style or 0,
-            'local_trend': row.local_trend or 0,
-            'playful_pop': row.playful_pop or 0,
-            'design_master': row.design_master or 0,
-            'global_trend': row.global_trend or 0,
-            'smart_local': row.smart_local or 0,
-            'smart_pick': row.smart_pick or 0
-        }
-        products.append(Item(
-            id=row.product_code,
-            name=row.name,
-            description=row.description,
-            image_url=row.image_url,
-            preferences=PreferenceVector(**pref_dict)
-        ))
-    return SelectionResponse(suppliers=suppliers, products=products)
+def get_items_for_selection(
+    request: Request,
+    seed: Optional[int] = Query(None, ge=0),
+    mode: Literal["random", "adaptive"] = "random",
+    user_id: Optional[int] = None,
+    db: Session = Depends(get_db),
+):
+    """
+    seedを指定すると、同じカタログのバージョンの間は同じ選択肢を返す（CDN・ブラウザでキャッシュできる）
+    seedは SELECTION_SEED_BUCKETS 個のバケットに丸めるため、キャッシュされる組み合わせは有限になる
+    mode=adaptive では、少ないラウンドで嗜好ベクトルが定まるよう情報量の多い商品を選ぶ（カタログ未ロード時は random と同じ）
+    """
+    catalog = get_catalog() if CATALOG_ENABLED else None
+    if mode == "adaptive" and catalog is not None:
+        return adaptive_selection_response(db, catalog, user_id)
+    if seed is not None and catalog is not None and SELECTION_SEED_BUCKETS > 0:
+        return seeded_selection_response(request, db, catalog, seed % SELECTION_SEED_BUCKETS)
+    # 補充済みのレスポンスがあればそのまま返す（なくなった場合はその場で生成する）
+    payload = selection_pool.pop(
+        catalog.version if catalog is not None else None,
+        lambda ids: selection_ids_exist(catalog, *ids),
+    )
+    if payload is not None:
+        return Response(content=payload, media_type="application/json")
+    return ORJSONResponse(build_selection_payload(db, catalog))
+
+@app.get("/preferences/selection/pool/stats")
+def get_selection_pool_stats():
+    return selection_pool.stats()
 
 @app.post("/users/preferences")
-def save_preferences(request: PreferenceRequest, db: Session = Depends(get_db)):
-    final_scores = calculate_preference_vector(request.shown_items, request.selected_ids)
+def save_preferences(request: Union[PreferenceIdsRequest, PreferenceRequest], db: Session = Depends(get_db)):
+    """shown_items（アイテム全体）または shown_ids（idのみ）のどちらの形式も受け付ける"""
+    if isinstance(request, PreferenceIdsRequest):
+        final_scores = calculate_preference_vector_from_ids(db, request.shown_ids, request.selected_ids)
+    else:
+        final_scores = calculate_preference_vector(request.shown_items, request.selected_ids)
     try:
         set_clause = ", ".join([f"{key} = :{key}" for key in final_scores.keys()])
         params = {"user_id": request.user_id, **final_scores}
-        update_query = text(f"UPDATE users SET {set_clause} WHERE user_id = :user_id")
+        # preference_versionを進めて、このユーザーのレコメンドキャッシュを無効化する
+        update_query = text(f"UPDATE users SET {set_clause}, preference_version = preference_version + 1 WHERE user_id = :user_id")
         result = db.execute(update_query, params)
         db.commit()
         if result.rowcount == 0: raise HTTPException(status_code=404, detail=f"User with ID {request.user_id} not found.")
@@ -281,70 +524,381 @@ def login_for_access_token(username: Annotated[str, Form()], password: Annotated
         raise HTTPException(status_code=401, detail="Incorrect email or password", headers={"WWW-Authenticate": "Bearer"})
     return {"access_token": "dummy_token", "token_type": "bearer", "email": user.email, "user_id": user.user_id}
 
-@app.get("/recommendations", response_model=RecommendationResponse)
-def get_recommendations(user_id: int, latitude: float, longitude: float, db: Session = Depends(get_db)):
-    user_result = db.execute(text("SELECT * FROM users WHERE user_id = :uid"), {"uid": user_id}).first()
-    if not user_result:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    user_prefs_dict = {key: getattr(user_result, key, 0) for key in PreferenceVector.model_fields.keys()}
-    user_vector = np.array(list(user_prefs_dict.values()))
+def find_nearby_products(catalog, latitude: float, longitude: float):
+    """
+    グリッドインデックスで周辺セルの仕入先に絞り込み、仕入先単位で距離を計算する
+    半径内の仕入先の商品について (商品行番号, 距離) を返す
+    """
+    with stage("spatial_index"):
+        candidates = catalog.spatial_index.query_radius(latitude, longitude, RECOMMENDATION_RADIUS_KM)
+    with stage("distance"):
+        supplier_distances = haversine_distances(latitude, longitude, catalog.supplier_lat[candidates], catalog.supplier_lng[candidates])
+        within_radius = supplier_distances <= RECOMMENDATION_RADIUS_KM
+        rows, counts = catalog.supplier_product_rows(candidates[within_radius])
+        return rows, np.repeat(supplier_distances[within_radius], counts)
+
+def rank_recommendations(catalog, rows, match_percentages, distances=None, limit: Optional[int] = None, cursor=None):
+    """
+    スコア計算済みの候補を40%以上かつカーソル以降に絞り、ページ分を表示順（スコア降順）に並べる
+    アイテムは組み立てず、(行番号, スコア, 距離, 次ページのカーソル) を返す
+    distancesがNoneの場合（全国レコメンド）は距離をNaNとする
+    """
+    if distances is None:
+        distances = np.full(len(rows), np.nan)
+    with stage("top_k"):
+        matched = match_percentages >= MIN_MATCH_PERCENTAGE
+        rows, scores, distances = rows[matched], match_percentages[matched], distances[matched]
+        product_ids = catalog.product_ids[rows]
+
+        if cursor is not None:
+            after = after_cursor_mask(scores, product_ids, cursor)
+            rows, scores, distances, product_ids = rows[after], scores[after], distances[after], product_ids[after]
+
+        # 返却するページ分だけを部分選択する
+        page = top_k_indices(scores, product_ids, limit)
+        next_cursor = None
+        if limit is not None and len(scores) > limit:
+            next_cursor = encode_cursor(scores[page[-1]], product_ids[page[-1]])
+    return rows[page], scores[page], distances[page], next_cursor
+
+def iter_recommendation_items(catalog, rows, scores, distances):
+    """rank_recommendations の結果から、レスポンスのアイテムを1件ずつ組み立てる"""
+    for i, score, distance in zip(rows, scores, distances):
+        # 全国レコメンドでは距離がなく（NaN）、位置情報のない商品も含まれる
+        distance = float(distance)
+        yield {
+            "id": catalog.product_codes[i],
+            "name": catalog.names[i],
+            "description": catalog.descriptions[i],
+            "image_url": catalog.image_urls[i],
+            "preferences": catalog.preference_dict(i),
+            "location": catalog.product_location(i),
+            "match_score": score,
+            "distance_km": None if np.isnan(distance) else round(distance, 1),
+        }
 
+def build_recommendation_page(catalog, rows, match_percentages, distances=None, limit: Optional[int] = None, cursor=None):
+    """スコア計算済みの候補からページ分のアイテムを組み立て、(アイテム, 次ページのカーソル) を返す"""
+    rows, scores, distances, next_cursor = rank_recommendations(catalog, rows, match_percentages, distances, limit, cursor)
+    with stage("build"):
+        recommendations = list(iter_recommendation_items(catalog, rows, scores, distances))
+    return recommendations, next_cursor
+
+def recommend_from_catalog(catalog, user_vector, latitude: float, longitude: float, limit: Optional[int] = None, cursor=None, stream: bool = False):
+    """
+    インメモリカタログを使ってレコメンドを計算し、(ページ内のアイテム, 次ページのカーソル) を返す
+    stream=True の場合、アイテムはリストではなくスコア順に1件ずつ組み立てるジェネレーターになる
+    """
+    nearby, distances = find_nearby_products(catalog, latitude, longitude)
+    with stage("scoring"):
+        match_percentages = cosine_match_percentages(user_vector, catalog.preferences[nearby], catalog.preference_norms[nearby])
+    if stream:
+        rows, scores, distances, next_cursor = rank_recommendations(catalog, nearby, match_percentages, distances, limit, cursor)
+        return iter_recommendation_items(catalog, rows, scores, distances), next_cursor
+    return build_recommendation_page(catalog, nearby, match_percentages, distances, limit, cursor)
+
+def recommend_batch_from_catalog(catalog, user_matrix, locations, limit: int):
+    """
+    複数の (ユーザーベクトル, 位置) をまとめて計算し、クエリ毎に上位limit件を返す
+    位置が同じセル（BATCH_GROUP_CELL_DEG）のクエリをまとめ、グループ内の周辺商品の和集合に対して行列積でスコアを求める
+    （離れたクエリ同士をまとめると和集合×ユーザー数が膨らむため）。1回の行列積は BATCH_SCORE_BLOCK 要素までに分割する
+    """
+    nearby_list = [find_nearby_products(catalog, latitude, longitude) for latitude, longitude in locations]
+    groups = {}
+    for j, (latitude, longitude) in enumerate(locations):
+        groups.setdefault(location_cell(latitude, longitude, BATCH_GROUP_CELL_DEG), []).append(j)
+
+    results = [None] * len(locations)
+    for members in groups.values():
+        with stage("scoring"):
+            union = np.unique(np.concatenate([nearby_list[j][0] for j in members]))
+            chunk = max(1, BATCH_SCORE_BLOCK // max(len(union), 1))
+            for start in range(0, len(members), chunk):
+                part = members[start:start + chunk]
+                # 1件ずつに分かれる場合は、そのクエリの周辺商品だけを計算する
+                rows = np.unique(nearby_list[part[0]][0]) if len(part) == 1 else union
+                score_matrix = cosine_match_percentage_matrix(user_matrix[part], catalog.preferences[rows], catalog.preference_norms[rows])
+                for column, j in enumerate(part):
+                    nearby, distances = nearby_list[j]
+                    match_percentages = score_matrix[np.searchsorted(rows, nearby), column]
+                    results[j] = build_recommendation_page(catalog, nearby, match_percentages, distances, limit)
+    return results
+
+def recommend_from_db(db: Session, user_vector, latitude: float, longitude: float, limit: Optional[int] = None, cursor=None):
+    """カタログ未ロード時のフォールバック：周辺の仕入先の商品だけをDBから取得してレコメンドを計算する"""
     # ★★★ 1. p.product_code をSELECT文に追加 ★★★
+    # suppliers.lat/lng（locationから展開した生成カラム）の範囲条件でインデックスを使って絞り込む
     query = text("""
         SELECT
             p.product_id, p.product_code, p.name AS product_name, p.description, p.image_url,
-            s.location,
+            s.lat, s.lng,
             p.heritage_soul, p.modern_heirloom, p.folk_heart, p.fresh_folk, 
             p.masterpiece, p.innovative_classic, p.craft_sense, p.smart_craft, 
             p.signature_mood, p.iconic_style, p.local_trend, p.playful_pop, 
             p.design_master, p.global_trend, p.smart_local, p.smart_pick
         FROM products p
         JOIN suppliers s ON p.supplier_id = s.supplier_id
+        WHERE s.lat BETWEEN :min_lat AND :max_lat
+          AND s.lng BETWEEN :min_lng AND :max_lng
+        ORDER BY p.product_id
     """)
-    all_products = db.execute(query).fetchall()
-
-    recommendations = []
-    for product in all_products:
-        supplier_location = json.loads(product.location) if isinstance(product.location, str) else product.location
-        if not supplier_location or 'lat' not in supplier_location or 'lng' not in supplier_location:
-            continue
-
-        distance = haversine_distance(latitude, longitude, supplier_location['lat'], supplier_location['lng'])
-        if distance > 10:
-            continue
+    min_lat, max_lat, min_lng, max_lng = bounding_box(latitude, longitude, RECOMMENDATION_RADIUS_KM)
+    params = {"min_lat": min_lat, "max_lat": max_lat, "min_lng": min_lng, "max_lng": max_lng}
+    with stage("db_query"):
+        nearby_products = db.execute(query, params).fetchall()
+
+    with stage("distance_scoring"):
+        matches = []
+        for product in nearby_products:
+            distance = haversine_distance(latitude, longitude, product.lat, product.lng)
+            if distance > RECOMMENDATION_RADIUS_KM:
+                continue
             
-        product_prefs_dict = {key: getattr(product, key, 0) for key in PreferenceVector.model_fields.keys()}
-        product_vector = np.array(list(product_prefs_dict.values()))
+            product_prefs_dict = {key: getattr(product, key, 0) for key in PreferenceVector.model_fields.keys()}
+            product_vector = np.array(list(product_prefs_dict.values()))
         
-        dot_product = np.dot(user_vector, product_vector)
-        norm_user = np.linalg.norm(user_vector)
-        norm_product = np.linalg.norm(product_vector)
+            dot_product = np.dot(user_vector, product_vector)
+            norm_user = np.linalg.norm(user_vector)
+            norm_product = np.linalg.norm(product_vector)
         
-        score = 0
-        if norm_user > 0 and norm_product > 0:
-            score = dot_product / (norm_user * norm_product)
+            score = 0
+            if norm_user > 0 and norm_product > 0:
+                score = dot_product / (norm_user * norm_product)
         
-        match_percentage = int(score * 100)
+            match_percentage = int(score * 100)
         
-        if match_percentage < 40:
+            if match_percentage < 40:
+                continue
+
+            # ページングのキーで並べ替えるため、アイテムの生成は後で行う
+            matches.append((match_percentage, product, product_prefs_dict, distance))
+
+    matches.sort(key=lambda match: (-match[0], match[1].product_id))
+    if cursor is not None:
+        cursor_score, cursor_id = cursor
+        matches = [match for match in matches if (match[0], -match[1].product_id) < (cursor_score, -cursor_id)]
+    next_cursor = None
+    if limit is not None and len(matches) > limit:
+        matches = matches[:limit]
+        next_cursor = encode_cursor(matches[-1][0], matches[-1][1].product_id)
+
+    with stage("build"):
+        recommendations = []
+        for match_percentage, product, product_prefs_dict, distance in matches:
+            recommendations.append({
+                # ★★★ 2. idをproduct_codeに変更 ★★★
+                "id": product.product_code,
+                "name": product.product_name,
+                "description": product.description,
+                "image_url": product.image_url,
+                "preferences": product_prefs_dict,
+                "location": {"lat": product.lat, "lng": product.lng},
+                "match_score": match_percentage,
+                "distance_km": round(distance, 1),
+            })
+    return recommendations, next_cursor
+
+def ndjson_response(items, next_cursor: Optional[str] = None) -> StreamingResponse:
+    """アイテムを1行1件のJSONとして順に送る（次ページのカーソルはヘッダーで返す）"""
+    def lines():
+        for item in items:
+            yield orjson.dumps(item, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n"
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE, headers=headers)
+
+def lookup_recommendation_request(db: Session, user_id: int, latitude: float, longitude: float, limit: Optional[int], cursor: Optional[str]):
+    """
+    ユーザーの嗜好ベクトルの取得・カーソルの検証・キャッシュの確認を行う
+    (ユーザーベクトル, デコード済みのカーソル, カタログ, キャッシュキー, キャッシュ済みのレスポンス, 事前計算結果) を返す
+    事前計算結果はキャッシュにない先頭ページのリクエストでのみ主キーで検索する
+    """
+    with stage("user_query"):
+        user_result = db.execute(text("SELECT * FROM users WHERE user_id = :uid"), {"uid": user_id}).first()
+    if not user_result:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    user_prefs_dict = {key: getattr(user_result, key, 0) for key in PreferenceVector.model_fields.keys()}
+    user_vector = np.array(list(user_prefs_dict.values()))
+
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    catalog = get_catalog() if CATALOG_ENABLED else None
+    # 嗜好の更新やカタログの再読み込みでキーが変わるため、古い結果は返らない
+    cache_key = (
+        user_id,
+        location_cell(latitude, longitude, RECOMMENDATION_CACHE_CELL_DEG),
+        getattr(user_result, "preference_version", 0),
+        catalog.version if catalog is not None else None,
+        limit,
+        cursor,
+    )
+    with stage("cache"):
+        cached = recommendation_cache.get(cache_key)
+    precomputed = None
+    if cached is None and PRECOMPUTED_ENABLED and catalog is not None and after is None:
+        with stage("precomputed"):
+            cell = hotspot_cell(latitude, longitude, PRECOMPUTED_CELL_DEG)
+            precomputed = lookup_precomputed(db, user_id, cell, getattr(user_result, "preference_version", 0), catalog.scoring_version)
+    return user_vector, after, catalog, cache_key, cached, precomputed
+
+def recommend_from_precomputed(catalog, precomputed, latitude: float, longitude: float, limit: Optional[int], stream: bool):
+    """
+    事前計算結果から先頭ページを組み立てる（距離はリクエストの位置から計算し、半径外の商品は除く）
+    保存件数がページに足りない場合はNoneを返す
+    """
+    with stage("build"):
+        # 事前計算の後に削除された商品は除く
+        rows = catalog.rows_for_product_ids(precomputed.product_ids)
+        found = rows >= 0
+        rows, scores, product_ids = rows[found], precomputed.match_scores[found], precomputed.product_ids[found]
+        suppliers = catalog.product_suppliers[rows]
+        distances = haversine_distances(latitude, longitude, catalog.supplier_lat[suppliers], catalog.supplier_lng[suppliers])
+        page = precomputed.page(distances <= RECOMMENDATION_RADIUS_KM, limit)
+        if page is None:
+            return None
+        positions, has_more = page
+        rows, scores, product_ids, distances = rows[positions], scores[positions], product_ids[positions], distances[positions]
+        next_cursor = encode_cursor(scores[-1], product_ids[-1]) if has_more and len(rows) else None
+        items = iter_recommendation_items(catalog, rows, scores, distances)
+        if not stream:
+            items = list(items)
+    return items, next_cursor
+
+def compute_recommendations(db: Session, catalog, user_vector, latitude: float, longitude: float, limit: Optional[int], cursor, stream: bool):
+    if catalog is not None:
+        return recommend_from_catalog(catalog, user_vector, latitude, longitude, limit, cursor, stream)
+    return recommend_from_db(db, user_vector, latitude, longitude, limit, cursor)
+
+async def recommend_with_scoring_pool(catalog, user_vector, latitude: float, longitude: float, limit: Optional[int], cursor, stream: bool):
+    """recommend_from_catalog と同じ結果を、スコアリングだけプロセスプールで計算して返す"""
+    nearby, distances = await run_in_threadpool(find_nearby_products, catalog, latitude, longitude)
+    with stage("scoring"):
+        match_percentages = await scoring_pool.score(catalog, user_vector, nearby)
+    if stream:
+        rows, scores, distances, next_cursor = await run_in_threadpool(rank_recommendations, catalog, nearby, match_percentages, distances, limit, cursor)
+        return iter_recommendation_items(catalog, rows, scores, distances), next_cursor
+    return await run_in_threadpool(build_recommendation_page, catalog, nearby, match_percentages, distances, limit, cursor)
+
+@app.get("/recommendations", response_model=RecommendationResponse)
+async def get_recommendations(
+    request: Request,
+    user_id: int,
+    latitude: float,
+    longitude: float,
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    """
+    Accept: application/x-ndjson の場合は、アイテムをスコアの高い順に組み立てながらストリーミングで返す
+    （全件のアイテムをメモリ上に組み立てないため、最初のアイテムまでの時間が候補数に依存しない）
+    DBアクセスとCPU処理はスレッドプール（SCORING_WORKERS 指定時のスコアリングはプロセスプール）で実行する
+    ホットスポットの先頭ページは、事前計算結果（recommendations_cache）を主キーで取得して返す
+    """
+    stream = NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+    user_vector, after, catalog, cache_key, cached, precomputed = await run_in_threadpool(
+        lookup_recommendation_request, db, user_id, latitude, longitude, limit, cursor
+    )
+    if cached is not None:
+        mark_handler_done()
+        if stream:
+            return ndjson_response(cached["items"], cached["next_cursor"])
+        return ORJSONResponse(cached)
+
+    page = None
+    if precomputed is not None:
+        page = await run_in_threadpool(recommend_from_precomputed, catalog, precomputed, latitude, longitude, limit, stream)
+    if page is not None:
+        recommendations, next_cursor = page
+    elif catalog is not None and scoring_pool is not None:
+        recommendations, next_cursor = await recommend_with_scoring_pool(catalog, user_vector, latitude, longitude, limit, after, stream)
+    else:
+        recommendations, next_cursor = await run_in_threadpool(
+            compute_recommendations, db, catalog, user_vector, latitude, longitude, limit, after, stream
+        )
+    if stream:
+        # ストリーミング時はアイテムを保持しないため、キャッシュには保存しない
+        mark_handler_done()
+        return ndjson_response(recommendations, next_cursor)
+
+    response = {"items": recommendations, "next_cursor": next_cursor}
+    recommendation_cache.put(cache_key, response)
+    mark_handler_done()
+    return ORJSONResponse(response)
+
+@app.post("/recommendations/batch", response_model=BatchRecommendationResponse)
+def get_batch_recommendations(request: BatchRecommendationRequest, db: Session = Depends(get_db)):
+    preference_keys = list(PreferenceVector.model_fields.keys())
+    user_ids = sorted({query.user_id for query in request.queries})
+    user_query = text(f"SELECT user_id, {', '.join(preference_keys)} FROM users WHERE user_id IN :uids").bindparams(bindparam("uids", expanding=True))
+    with stage("user_query"):
+        user_vectors = {
+            row.user_id: [getattr(row, key) or 0 for key in preference_keys]
+            for row in db.execute(user_query, {"uids": user_ids})
+        }
+
+    found = [query for query in request.queries if query.user_id in user_vectors]
+    catalog = get_catalog() if CATALOG_ENABLED else None
+    if not found:
+        pages = []
+    elif catalog is not None:
+        user_matrix = np.array([user_vectors[query.user_id] for query in found])
+        pages = recommend_batch_from_catalog(catalog, user_matrix, [(query.latitude, query.longitude) for query in found], request.limit)
+    else:
+        pages = [recommend_from_db(db, np.array(user_vectors[query.user_id]), query.latitude, query.longitude, request.limit) for query in found]
+
+    pages = iter(pages)
+    results = []
+    for query in request.queries:
+        if query.user_id not in user_vectors:
+            results.append({**query.model_dump(), "items": [], "next_cursor": None, "error": "User not found"})
             continue
+        recommendations, next_cursor = next(pages)
+        results.append({**query.model_dump(), "items": recommendations, "next_cursor": next_cursor, "error": None})
+    mark_handler_done()
+    return ORJSONResponse({"results": results})
+
+@app.get("/recommendations/nationwide", response_model=RecommendationResponse)
+def get_nationwide_recommendations(
+    user_id: int,
+    limit: int = Query(20, ge=1, le=500),
+    n_probe: int = Query(ANN_N_PROBE, ge=1),
+    db: Session = Depends(get_db),
+):
+    """位置を指定せず、全国の商品から嗜好に近い上位limit件を近似検索で返す"""
+    with stage("user_query"):
+        user_result = db.execute(text("SELECT * FROM users WHERE user_id = :uid"), {"uid": user_id}).first()
+    if not user_result:
+        raise HTTPException(status_code=404, detail="User not found")
+    user_vector = np.array([getattr(user_result, key, 0) for key in PreferenceVector.model_fields.keys()])
+
+    catalog = get_catalog() if CATALOG_ENABLED else None
+    if catalog is None:
+        raise HTTPException(status_code=503, detail="Product catalog is not loaded")
+
+    index = get_ivf_index()
+    if index is None:
+        raise HTTPException(status_code=503, detail="ANN index is not ready")
+
+    with stage("ann_search"):
+        candidates = index.search(user_vector, n_probe, catalog)
+    with stage("scoring"):
+        match_percentages = cosine_match_percentages(user_vector, catalog.preferences[candidates], catalog.preference_norms[candidates])
+    recommendations, _ = build_recommendation_page(catalog, candidates, match_percentages, limit=limit)
+    mark_handler_done()
+    return ORJSONResponse({"items": recommendations, "next_cursor": None})
+
+@app.get("/recommendations/cache/stats")
+def get_recommendation_cache_stats():
+    return recommendation_cache.stats()
+
+@app.get("/recommendations/timing/stats")
+def get_recommendation_timing_stats():
+    return stage_histograms.snapshot()
 
-        recommendations.append(RecommendationItem(
-            # ★★★ 2. idをproduct_codeに変更 ★★★
-            id=product.product_code,
-            name=product.product_name,
-            description=product.description,
-            image_url=product.image_url,
-            location=Location(**supplier_location),
-            preferences=PreferenceVector(**product_prefs_dict),
-            match_score=match_percentage,
-            distance_km=round(distance, 1)
-        ))
-        
-    recommendations.sort(key=lambda item: item.match_score, reverse=True)
-    
-    return RecommendationResponse(items=recommendations)
 @app.post("/favorites")
 def add_to_favorites(request: FavoriteRequest, db: Session = Depends(get_db)):
     item_id_str = request.item_id; user_id = request.user_id
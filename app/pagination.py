@@ -0,0 +1,48 @@
+"""
+レコメンド結果の上位K件選択とカーソルページング
+並び順は (match_score 降順, product_id 昇順) で固定し、カーソルには
+ページ最終要素のキーを入れる（カタログが更新されても位置がずれない）
+"""
+import base64
+from typing import Optional, Tuple
+
+import numpy as np
+
+
+def encode_cursor(match_score: int, product_id: int) -> str:
+    """ページ最終要素のキーから次ページ取得用のカーソル文字列を作る"""
+    raw = f"{int(match_score)}:{int(product_id)}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[int, int]:
+    """カーソル文字列を (match_score, product_id) に戻す（不正な場合はValueError）"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        match_score, product_id = raw.split(":")
+        return int(match_score), int(product_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def after_cursor_mask(scores: np.ndarray, ids: np.ndarray, cursor: Tuple[int, int]) -> np.ndarray:
+    """並び順でカーソルより後ろにある要素を True とするマスクを返す"""
+    cursor_score, cursor_id = cursor
+    return (scores < cursor_score) | ((scores == cursor_score) & (ids > cursor_id))
+
+
+def top_k_indices(scores: np.ndarray, ids: np.ndarray, k: Optional[int]) -> np.ndarray:
+    """
+    (score 降順, id 昇順) で上位k件のインデックスを並び順で返す
+    kがNoneまたは件数以上の場合は全件をソートする
+    """
+    if k is None or k >= len(scores):
+        return np.lexsort((ids, -scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+
+    # スコアとidを1つの整数キーにまとめ、argpartitionで上位k件だけを取り出す
+    stride = int(ids.max()) + 1
+    keys = (int(scores.max()) - scores.astype(np.int64)) * stride + ids
+    top = np.argpartition(keys, k - 1)[:k]
+    return top[np.argsort(keys[top])]
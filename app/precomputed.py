@@ -0,0 +1,139 @@
+"""
+人気エリア（ホットスポット）のセル毎に事前計算したレコメンド
+オフラインのバッチ（precompute_recommendations.py）がユーザー×セルの上位N件を
+recommendations_cache テーブルに保存し、APIは主キーの検索だけで結果を返す
+
+事前計算はセルの中心から「半径＋セルの対角線の半分」内の商品を対象に行い、
+APIはリクエストの位置からの距離で半径内の商品だけに絞り込む（絞り込んだ結果がページに足りない場合はライブで計算する）
+計算に使ったカタログの scoring_version を保存し、商品の追加・削除・嗜好や位置の変更があったカタログでは使わない
+"""
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import numpy as np
+import orjson
+from sqlalchemy import text
+
+from app.geo import haversine_distances
+from app.pagination import top_k_indices
+from app.rec_cache import location_cell
+from app.scoring import MIN_MATCH_PERCENTAGE, cosine_match_percentage_matrix
+
+# セルの大きさ（度）。0.01度は約1km
+DEFAULT_CELL_DEG = 0.01
+# ユーザー×セル毎に保存する件数
+DEFAULT_TOP_N = 100
+
+LOOKUP_QUERY = text("""
+    SELECT preference_version, catalog_version, product_ids, match_scores, total_matches
+    FROM recommendations_cache
+    WHERE user_id = :user_id AND cell_lat = :cell_lat AND cell_lng = :cell_lng
+""")
+SAVE_QUERY = text("""
+    REPLACE INTO recommendations_cache
+        (user_id, cell_lat, cell_lng, preference_version, catalog_version, product_ids, match_scores, total_matches)
+    VALUES (:user_id, :cell_lat, :cell_lng, :preference_version, :catalog_version, :product_ids, :match_scores, :total_matches)
+""")
+
+
+@dataclass(frozen=True)
+class PrecomputedRecommendations:
+    """1ユーザー×1セルの事前計算結果（スコア降順・product_id昇順）"""
+    product_ids: np.ndarray
+    match_scores: np.ndarray
+    total_matches: int           # 40%以上の商品の総数（保存件数より多い場合がある）
+
+    def page(self, within: np.ndarray, limit: Optional[int]) -> Optional[Tuple[np.ndarray, bool]]:
+        """
+        within（保存した各商品がリクエストの位置から半径内か）で絞り込んだ先頭ページの (保存順の位置, 次ページの有無) を返す
+        保存件数が足りずページが確定しない場合はNone（ライブのスコアリングで計算する）
+        """
+        positions = np.flatnonzero(within)
+        if limit is not None and len(positions) > limit:
+            return positions[:limit], True
+        # 保存していない下位の商品がページに入る可能性がある
+        if self.total_matches > len(self.product_ids):
+            return None
+        return positions, False
+
+
+def hotspot_cell(latitude: float, longitude: float, cell_deg: float = DEFAULT_CELL_DEG):
+    return location_cell(latitude, longitude, cell_deg)
+
+
+def cell_center(cell, cell_deg: float = DEFAULT_CELL_DEG):
+    return (cell[0] + 0.5) * cell_deg, (cell[1] + 0.5) * cell_deg
+
+
+def cell_half_diagonal_km(cell, cell_deg: float = DEFAULT_CELL_DEG) -> float:
+    """セルの中心から最も遠い角までの距離（km）"""
+    latitude, longitude = cell_center(cell, cell_deg)
+    corner_lat = np.array([cell[0], cell[0], cell[0] + 1, cell[0] + 1]) * cell_deg
+    corner_lng = np.array([cell[1], cell[1] + 1, cell[1], cell[1] + 1]) * cell_deg
+    return float(haversine_distances(latitude, longitude, corner_lat, corner_lng).max())
+
+
+def lookup_precomputed(db, user_id: int, cell, preference_version: int, catalog_version: str) -> Optional[PrecomputedRecommendations]:
+    """
+    主キーで事前計算結果を取得する
+    未計算、またはユーザーの嗜好・カタログ（catalog.scoring_version）が計算後に変わった場合はNone
+    """
+    row = db.execute(LOOKUP_QUERY, {"user_id": user_id, "cell_lat": cell[0], "cell_lng": cell[1]}).first()
+    if row is None or row.preference_version != preference_version or row.catalog_version != catalog_version:
+        return None
+    return PrecomputedRecommendations(
+        product_ids=np.array(orjson.loads(row.product_ids), dtype=np.int64),
+        match_scores=np.array(orjson.loads(row.match_scores), dtype=np.int64),
+        total_matches=row.total_matches,
+    )
+
+
+def find_hotspot_cells(catalog, count: int, cell_deg: float = DEFAULT_CELL_DEG) -> List[tuple]:
+    """商品数の多い順に count 個のセルを返す"""
+    located = np.flatnonzero(~np.isnan(catalog.supplier_lat))
+    if len(located) == 0:
+        return []
+    cells = np.stack([
+        np.floor(catalog.supplier_lat[located] / cell_deg),
+        np.floor(catalog.supplier_lng[located] / cell_deg),
+    ], axis=1).astype(np.int64)
+    product_counts = np.diff(catalog.supplier_offsets)[located]
+    unique_cells, inverse = np.unique(cells, axis=0, return_inverse=True)
+    totals = np.bincount(inverse.reshape(-1), weights=product_counts)
+    order = np.argsort(-totals, kind="stable")[:count]
+    return [tuple(cell) for cell in unique_cells[order].tolist()]
+
+
+def precompute_cell(catalog, user_matrix: np.ndarray, cell, radius_km: float, top_n: int = DEFAULT_TOP_N,
+                    cell_deg: float = DEFAULT_CELL_DEG) -> List[PrecomputedRecommendations]:
+    """
+    ユーザー毎の上位 top_n 件を計算する（user_matrix の行順）
+    セル内のどの位置から半径 radius_km 内の商品も含まれるよう、中心から radius_km ＋対角線の半分内の商品を対象にする
+    """
+    latitude, longitude = cell_center(cell, cell_deg)
+    search_km = radius_km + cell_half_diagonal_km(cell, cell_deg)
+    candidates = catalog.spatial_index.query_radius(latitude, longitude, search_km)
+    distances = haversine_distances(latitude, longitude, catalog.supplier_lat[candidates], catalog.supplier_lng[candidates])
+    rows, _ = catalog.supplier_product_rows(candidates[distances <= search_km])
+    product_ids = catalog.product_ids[rows]
+
+    score_matrix = cosine_match_percentage_matrix(user_matrix, catalog.preferences[rows], catalog.preference_norms[rows])
+    results = []
+    for scores in score_matrix.T:
+        matched = np.flatnonzero(scores >= MIN_MATCH_PERCENTAGE)
+        top = matched[top_k_indices(scores[matched], product_ids[matched], top_n)]
+        results.append(PrecomputedRecommendations(product_ids[top], scores[top], len(matched)))
+    return results
+
+
+def save_precomputed(conn, user_id: int, cell, preference_version: int, catalog_version: str, entry: PrecomputedRecommendations):
+    conn.execute(SAVE_QUERY, {
+        "user_id": user_id,
+        "cell_lat": cell[0],
+        "cell_lng": cell[1],
+        "preference_version": preference_version,
+        "catalog_version": catalog_version,
+        "product_ids": orjson.dumps(entry.product_ids, option=orjson.OPT_SERIALIZE_NUMPY).decode(),
+        "match_scores": orjson.dumps(entry.match_scores, option=orjson.OPT_SERIALIZE_NUMPY).decode(),
+        "total_matches": entry.total_matches,
+    })
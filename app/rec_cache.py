@@ -0,0 +1,77 @@
+"""
+レコメンド結果のキャッシュ
+(ユーザー, 量子化した位置セル, 嗜好バージョン, カタログバージョン, ページ指定) をキーに
+計算済みのレスポンスを保持する、件数上限とTTL付きのLRUキャッシュ
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+def location_cell(latitude: float, longitude: float, cell_deg: float):
+    """緯度経度をキャッシュキー用のセル番号に量子化する"""
+    return math.floor(latitude / cell_deg), math.floor(longitude / cell_deg)
+
+
+class RecommendationCache:
+    """件数上限とTTL付きのスレッドセーフなLRUキャッシュ"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """キャッシュ済みの値を返す（ない場合や期限切れの場合はNone）"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        """値を保存し、上限を超えた場合は最も古く使われたエントリを削除する"""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """TTLやセルサイズの調整用に統計情報を返す"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
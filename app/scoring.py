@@ -0,0 +1,91 @@
+"""
+嗜好ベクトルのコサイン類似度スコアリング
+商品行列は1バイト整数に圧縮し、行ノルムを事前計算しておく
+スコアは整数の内積を1回の行列ベクトル積で求め、最後に一度だけ浮動小数点でノルムを割る
+"""
+import numpy as np
+
+# レコメンド対象とする最低マッチ率（%）
+MIN_MATCH_PERCENTAGE = 40
+# レコメンド対象とする半径（km）。APIと事前計算のバッチで共通
+RECOMMENDATION_RADIUS_KM = 10
+
+# float32の仮数部(24bit)で整数を正確に表せる上限
+FLOAT32_EXACT_LIMIT = 2 ** 24
+# float32へ変換しながら内積を取る際の行数（変換後のブロックをCPUキャッシュに収める）
+DOT_CHUNK_ROWS = 16384
+
+
+def compact_preference_matrix(matrix: np.ndarray) -> np.ndarray:
+    """値の範囲に収まる最小の整数型（通常はuint8/int8）に変換する"""
+    matrix = np.asarray(matrix)
+    if matrix.size == 0:
+        return matrix.astype(np.uint8)
+    low, high = int(matrix.min()), int(matrix.max())
+    for dtype in (np.uint8, np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return matrix.astype(dtype)
+    return matrix.astype(np.int64)
+
+
+def compute_row_norms(matrix: np.ndarray) -> np.ndarray:
+    """各行のL2ノルムを計算する（カタログ読み込み時に一度だけ実行）"""
+    return np.linalg.norm(matrix, axis=1)
+
+
+def integer_dots(matrix: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+    """
+    1バイト整数の行列と整数ベクトル（または列ごとのベクトル）の内積をint64で正確に求める
+    途中の和が必ず2^24未満に収まる場合はfloat32のBLASで計算する（整数演算と同じ結果になる）
+    """
+    vectors = np.asarray(vectors)
+    if vectors.dtype.kind not in "iub":
+        return matrix @ vectors
+    vectors = vectors.astype(np.int64, copy=False)
+    if matrix.dtype.kind not in "iu" or matrix.dtype.itemsize != 1 or len(matrix) == 0:
+        return matrix @ vectors
+
+    info = np.iinfo(matrix.dtype)
+    matrix_bound = max(-int(info.min), int(info.max))
+    if matrix_bound * int(np.abs(vectors).sum(axis=0).max(initial=0)) >= FLOAT32_EXACT_LIMIT:
+        return matrix @ vectors
+
+    vectors32 = vectors.astype(np.float32)
+    dots = np.empty((len(matrix),) + vectors.shape[1:], dtype=np.float32)
+    for start in range(0, len(matrix), DOT_CHUNK_ROWS):
+        np.matmul(matrix[start:start + DOT_CHUNK_ROWS].astype(np.float32), vectors32, out=dots[start:start + DOT_CHUNK_ROWS])
+    return dots.astype(np.int64)
+
+
+def cosine_match_percentages(user_vector: np.ndarray, matrix: np.ndarray, row_norms: np.ndarray) -> np.ndarray:
+    """
+    ユーザーベクトルと各行のコサイン類似度を int(score * 100) の整数配列で返す
+    どちらかのノルムが0の行はスコア0とする（従来のループ実装と同じ結果になる）
+    """
+    user_vector = np.asarray(user_vector)
+    dots = integer_dots(matrix, user_vector)
+    norm_user = np.linalg.norm(user_vector)
+    if norm_user <= 0:
+        return np.zeros(len(matrix), dtype=np.int64)
+
+    denominators = norm_user * row_norms
+    scores = np.zeros(len(matrix))
+    np.divide(dots, denominators, out=scores, where=denominators > 0)
+    # int() と同じく0方向へ切り捨てる
+    return np.trunc(scores * 100).astype(np.int64)
+
+
+def cosine_match_percentage_matrix(user_matrix: np.ndarray, matrix: np.ndarray, row_norms: np.ndarray) -> np.ndarray:
+    """
+    複数ユーザー分のマッチ率を1回の行列積で計算する
+    戻り値は (行数, ユーザー数) の整数配列で、各列は cosine_match_percentages と同じ値になる
+    """
+    user_matrix = np.asarray(user_matrix)
+    dots = integer_dots(matrix, user_matrix.T)
+    user_norms = np.linalg.norm(user_matrix, axis=1)
+
+    denominators = row_norms[:, None] * user_norms[None, :]
+    scores = np.zeros(dots.shape)
+    np.divide(dots, denominators, out=scores, where=denominators > 0)
+    return np.trunc(scores * 100).astype(np.int64)
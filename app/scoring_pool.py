@@ -0,0 +1,99 @@
+"""
+CPUを多く使うスコアリングを別プロセスで実行するためのプロセスプール
+各プロセスは共有カタログのスナップショット（CATALOG_SHARED_DIR）をメモリマップで参照し、
+候補行をシャードに分けて並列にスコアを計算する。APIワーカーのGILを占有しないため、
+レコメンドの負荷が同じワーカーの他のエンドポイントの応答時間に影響しにくくなる
+"""
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Optional
+
+import numpy as np
+
+from app.catalog import ProductCatalog
+from app.scoring import cosine_match_percentages
+from app.shared_catalog import KEEP_SNAPSHOTS, load_snapshot, read_current
+
+# 1シャードあたりの最小行数（少ない候補はプロセス間通信のほうが高くつくため分割しない）
+MIN_SHARD_ROWS = 20000
+
+
+class StaleCatalogError(Exception):
+    """呼び出し元のカタログのスナップショットをプール側のプロセスで読み込めない"""
+
+
+# --- プール側のプロセスで実行する関数 ---
+_shared_dir: Optional[str] = None
+# 読み込み済みのスナップショット（名前 → カタログ）。ディスクに残る数までを保持する
+_snapshots: Dict[str, ProductCatalog] = {}
+
+
+def _init_worker(shared_dir: str):
+    global _shared_dir
+    _shared_dir = shared_dir
+    name = read_current(shared_dir)
+    if name is not None:
+        _load_snapshot(name)
+
+
+def _load_snapshot(name: str) -> ProductCatalog:
+    catalog = _snapshots.get(name)
+    if catalog is None:
+        try:
+            catalog = load_snapshot(_shared_dir, name)
+        except OSError as e:
+            # 古いスナップショットが削除済みの場合など
+            raise StaleCatalogError(f"snapshot {name} is not available: {e}") from e
+        _snapshots[name] = catalog
+        while len(_snapshots) > KEEP_SNAPSHOTS:
+            del _snapshots[next(iter(_snapshots))]
+    return catalog
+
+
+def _score_shard(snapshot_name: str, user_vector: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    # CURRENTには追従せず、呼び出し元が参照しているスナップショットそのものを使う
+    catalog = _load_snapshot(snapshot_name)
+    return cosine_match_percentages(user_vector, catalog.preferences[rows], catalog.preference_norms[rows])
+
+
+class ScoringPool:
+    """共有カタログを参照するスコアリング用のプロセスプール"""
+
+    def __init__(self, workers: int, shared_dir: str, min_shard_rows: int = MIN_SHARD_ROWS):
+        self.workers = workers
+        self.min_shard_rows = min_shard_rows
+        # スレッドを持つAPIプロセスからのforkを避けるためspawnで起動する
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(shared_dir,),
+        )
+
+    async def score(self, catalog, user_vector: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """
+        catalog の rows 行のマッチ率を cosine_match_percentages と同じ値で返す
+        スナップショットから読み込んでいないカタログや、スナップショットが削除済みの場合などは、
+        スレッドで直接計算する
+        """
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.int64)
+        if catalog.snapshot_name is not None:
+            n_shards = max(1, min(self.workers, len(rows) // self.min_shard_rows))
+            loop = asyncio.get_running_loop()
+            try:
+                shards = await asyncio.gather(*(
+                    loop.run_in_executor(self._executor, _score_shard, catalog.snapshot_name, user_vector, shard)
+                    for shard in np.array_split(rows, n_shards)
+                ))
+                return np.concatenate(shards)
+            except (StaleCatalogError, BrokenProcessPool):
+                pass
+        return await asyncio.to_thread(
+            cosine_match_percentages, user_vector, catalog.preferences[rows], catalog.preference_norms[rows]
+        )
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
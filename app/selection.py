@@ -0,0 +1,259 @@
+"""
+初回の嗜好選択（/preferences/selection）で表示する仕入先・商品の無作為抽出
+カタログが持つ主キーの配列から乱数で選び、その行だけを主キーで取得する
+（ORDER BY RAND() のような全件の走査とソートを行わないため、テーブルの件数に依存しない）
+仕入先と商品は UNION ALL の1クエリで取得し、共通のデコーダーでアイテムに変換する
+
+adaptive モードでは、嗜好の16次元をなるべく広く覆う商品をカタログの嗜好行列から貪欲に選ぶ
+（2回目以降はユーザーの現在のベクトルで説明できない方向を優先する）
+
+さらに、シリアライズ済みのレスポンスをバックグラウンドで補充するリングバッファ（PayloadPool）に
+ためておき、リクエストでは取り出すだけにする。カタログが更新されても、生成から一定時間内で
+含まれる仕入先・商品が削除されていないものはそのまま返す（更新の度にプールを作り直さない）
+"""
+import operator
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Hashable, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import bindparam, text
+
+from app.catalog import PREFERENCE_KEYS
+
+# 仕入先・商品それぞれの表示件数
+SELECTION_SIZE = 3
+# 抽出後に削除された行があっても件数を満たせるよう、多めに抽出する
+OVERSAMPLE = 2
+# adaptive モードで情報量を評価する候補の商品数（全商品から無作為に抽出する）
+ADAPTIVE_CANDIDATES = 4096
+
+# 仕入先と商品の候補を1回のクエリで取得する（両者の列を揃えて UNION ALL する）
+_SELECTION_COLUMNS = "name, description, image_url, " + ", ".join(PREFERENCE_KEYS)
+SELECTION_QUERY = text(f"""
+    SELECT 'supplier' AS kind, supplier_id AS row_id, NULL AS code, {_SELECTION_COLUMNS}
+    FROM suppliers WHERE supplier_id IN :supplier_ids
+    UNION ALL
+    SELECT 'product' AS kind, product_id AS row_id, product_code AS code, {_SELECTION_COLUMNS}
+    FROM products WHERE product_id IN :product_ids
+""").bindparams(bindparam("supplier_ids", expanding=True), bindparam("product_ids", expanding=True))
+# カタログ未ロード時のフォールバック（MySQL用）
+RANDOM_SELECTION_QUERY = text(f"""
+    (SELECT 'supplier' AS kind, supplier_id AS row_id, NULL AS code, {_SELECTION_COLUMNS}
+     FROM suppliers ORDER BY RAND() LIMIT {SELECTION_SIZE})
+    UNION ALL
+    (SELECT 'product' AS kind, product_id AS row_id, product_code AS code, {_SELECTION_COLUMNS}
+     FROM products ORDER BY RAND() LIMIT {SELECTION_SIZE})
+""")
+
+# 選択結果（ids のみのペイロード）の嗜好ベクトルを解決するクエリ
+SUPPLIER_PREFERENCES_QUERY = text(
+    f"SELECT supplier_id, {', '.join(PREFERENCE_KEYS)} FROM suppliers WHERE supplier_id IN :supplier_ids"
+).bindparams(bindparam("supplier_ids", expanding=True))
+PRODUCT_PREFERENCES_QUERY = text(
+    f"SELECT product_code, {', '.join(PREFERENCE_KEYS)} FROM products WHERE product_code IN :product_codes"
+).bindparams(bindparam("product_codes", expanding=True))
+
+# 嗜好スコアの16列を行から一度に取り出す（kind, row_id, code, name, description, image_url の後に並ぶ）
+_PREFERENCE_OFFSET = 6
+_preference_columns = operator.itemgetter(*range(_PREFERENCE_OFFSET, _PREFERENCE_OFFSET + len(PREFERENCE_KEYS)))
+
+
+def decode_selection_row(row) -> dict:
+    """SELECTION_QUERY の1行をレスポンスのアイテムに変換する（仕入先のidは s{supplier_id}）"""
+    return {
+        "id": f"s{row.row_id}" if row.kind == "supplier" else row.code,
+        "name": row.name,
+        "description": row.description,
+        "image_url": row.image_url,
+        "preferences": dict(zip(PREFERENCE_KEYS, [value or 0 for value in _preference_columns(row)])),
+    }
+
+
+def resolve_item_preferences(db, catalog, item_ids: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    選択肢のid（仕入先は s{supplier_id}、商品は product_code）の嗜好ベクトルを (len(item_ids), 16) の行列で返す
+    商品はカタログの product_code → 行の索引から引き、仕入先（カタログにない）とカタログ未ロード時の商品だけDBから取得する
+    2つ目の戻り値は解決できたidのマスク（削除済みなど見つからないidの行は0）
+    """
+    matrix = np.zeros((len(item_ids), len(PREFERENCE_KEYS)), dtype=np.float64)
+    found = np.zeros(len(item_ids), dtype=bool)
+    supplier_positions, product_positions = {}, {}
+    for i, item_id in enumerate(item_ids):
+        if item_id.startswith("s") and item_id[1:].isdigit():
+            supplier_positions.setdefault(int(item_id[1:]), []).append(i)
+        else:
+            product_positions.setdefault(item_id, []).append(i)
+
+    if catalog is not None and product_positions:
+        codes = list(product_positions)
+        rows = catalog.rows_for_product_codes(codes)
+        for code, row in zip(codes, rows.tolist()):
+            if row >= 0:
+                positions = product_positions[code]
+                matrix[positions] = catalog.preferences[row]
+                found[positions] = True
+        product_positions = {}
+
+    if supplier_positions:
+        for row in db.execute(SUPPLIER_PREFERENCES_QUERY, {"supplier_ids": list(supplier_positions)}):
+            positions = supplier_positions[row.supplier_id]
+            matrix[positions] = [value or 0 for value in row[1:]]
+            found[positions] = True
+    if product_positions:
+        for row in db.execute(PRODUCT_PREFERENCES_QUERY, {"product_codes": list(product_positions)}):
+            positions = product_positions[row.product_code]
+            matrix[positions] = [value or 0 for value in row[1:]]
+            found[positions] = True
+    return matrix, found
+
+
+def sample_ids(ids: np.ndarray, k: int, rng: np.random.Generator) -> np.ndarray:
+    """ids から重複なしでk件を無作為に選ぶ（件数が大きい場合もkに比例した時間で済む）"""
+    if len(ids) <= k:
+        return rng.permutation(ids)
+    return ids[rng.choice(len(ids), k, replace=False)]
+
+
+def informative_rows(catalog, k: int, user_vector=None, rng: Optional[np.random.Generator] = None,
+                     candidates: int = ADAPTIVE_CANDIDATES) -> np.ndarray:
+    """
+    嗜好の16次元をなるべく広く覆う商品の行を最大k件選ぶ（ピボット付きグラム・シュミットによる貪欲法）
+    選択済みの商品と user_vector が張る空間からはみ出す成分（残差）が最も大きい商品を順に選ぶため、
+    現在のベクトルでは説明できない方向の好みを優先して尋ねることになる
+    """
+    rng = rng or np.random.default_rng()
+    rows = sample_ids(np.arange(len(catalog)), candidates, rng)
+    norms = catalog.preference_norms[rows]
+    rows, norms = rows[norms > 0], norms[norms > 0]
+    residual = catalog.preferences[rows].astype(np.float64) / norms[:, None]
+
+    def project_out(direction):
+        residual[...] -= np.outer(residual @ direction, direction)
+
+    if user_vector is not None:
+        user_vector = np.asarray(user_vector, dtype=np.float64)
+        user_norm = np.linalg.norm(user_vector)
+        if user_norm > 0:
+            project_out(user_vector / user_norm)
+
+    chosen = []
+    for _ in range(min(k, len(rows))):
+        energy = np.einsum("ij,ij->i", residual, residual)
+        best = int(np.argmax(energy))
+        # 残りの候補がすべて張られた空間に含まれる
+        if energy[best] <= 1e-9:
+            break
+        chosen.append(best)
+        project_out(residual[best] / np.sqrt(energy[best]))
+    return rows[chosen]
+
+
+def build_selection(db, catalog, k: int = SELECTION_SIZE, rng: Optional[np.random.Generator] = None,
+                    adaptive: bool = False, user_vector=None) -> Tuple[dict, List[int], List[int]]:
+    """
+    選択肢として表示する仕入先・商品をk件ずつ無作為に選び、レスポンスのdictを組み立てる
+    カタログがある場合は仕入先・商品のid配列から抽出し、選んだ行だけを主キーで取得する
+    （仕入先は商品を持つもの＝カタログに含まれるものから選ぶ）
+    adaptive の場合、商品は informative_rows で選ぶ（仕入先の嗜好はカタログにないため無作為のまま）
+    (レスポンスのdict, 含まれる supplier_id のリスト, 含まれる product_id のリスト) を返す
+    """
+    if catalog is None:
+        rows = db.execute(RANDOM_SELECTION_QUERY).fetchall()
+        suppliers = [row for row in rows if row.kind == "supplier"]
+        products = [row for row in rows if row.kind == "product"]
+    else:
+        rng = rng or np.random.default_rng()
+        supplier_ids = sample_ids(catalog.supplier_ids, k * OVERSAMPLE, rng).tolist()
+        if adaptive:
+            product_ids = catalog.product_ids[informative_rows(catalog, k * OVERSAMPLE, user_vector, rng)].tolist()
+        else:
+            product_ids = sample_ids(catalog.product_ids, k * OVERSAMPLE, rng).tolist()
+        rows = {(row.kind, row.row_id): row for row in db.execute(SELECTION_QUERY, {"supplier_ids": supplier_ids, "product_ids": product_ids})}
+        # 抽出した順に並べ、抽出後に削除された行は飛ばす
+        suppliers = [rows[key] for key in (("supplier", i) for i in supplier_ids) if key in rows][:k]
+        products = [rows[key] for key in (("product", i) for i in product_ids) if key in rows][:k]
+    payload = {
+        "suppliers": [decode_selection_row(row) for row in suppliers],
+        "products": [decode_selection_row(row) for row in products],
+    }
+    return payload, [row.row_id for row in suppliers], [row.row_id for row in products]
+
+
+def build_selection_payload(db, catalog, k: int = SELECTION_SIZE, rng: Optional[np.random.Generator] = None,
+                            adaptive: bool = False, user_vector=None) -> dict:
+    """build_selection のレスポンスのdictだけを返す"""
+    return build_selection(db, catalog, k, rng, adaptive, user_vector)[0]
+
+
+def selection_ids_exist(catalog, supplier_ids: List[int], product_ids: List[int]) -> bool:
+    """選択肢の仕入先・商品がすべてカタログに残っているか（catalog.supplier_ids は昇順に並んでいる）"""
+    if catalog is None:
+        return False
+    if len(product_ids) and (catalog.rows_for_product_ids(product_ids) < 0).any():
+        return False
+    if len(supplier_ids):
+        positions = np.searchsorted(catalog.supplier_ids, supplier_ids)
+        if (positions >= len(catalog.supplier_ids)).any():
+            return False
+        return bool((catalog.supplier_ids[positions] == supplier_ids).all())
+    return True
+
+
+class PayloadPool:
+    """
+    シリアライズ済みのレスポンス（bytes）のリングバッファ
+    各レスポンスは1回だけ返す。生成時とカタログのバージョンが異なるものは、生成から max_age 秒以内で
+    is_valid（含まれるidがまだ存在するかの確認）を満たす場合だけ返し、それ以外は捨てる
+    """
+
+    def __init__(self, size: int, max_age: float = 60.0):
+        self.size = size
+        self.max_age = max_age
+        self._payloads: "deque[tuple]" = deque(maxlen=max(size, 0))
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.reused = 0
+        self.misses = 0
+        self.discarded = 0
+
+    def pop(self, version: Hashable, is_valid: Optional[Callable[[Any], bool]] = None) -> Optional[bytes]:
+        """
+        レスポンスを1つ取り出す（空の場合はNone）
+        古いバージョンのものは is_valid(push時の ids) で確認する（is_validがない場合は捨てる）
+        """
+        now = time.monotonic()
+        with self._lock:
+            while self._payloads:
+                payload_version, created_at, ids, payload = self._payloads.popleft()
+                if payload_version == version:
+                    self.hits += 1
+                    return payload
+                if is_valid is not None and now - created_at <= self.max_age and is_valid(ids):
+                    self.hits += 1
+                    self.reused += 1
+                    return payload
+                self.discarded += 1
+            self.misses += 1
+            return None
+
+    def push(self, version: Hashable, payload: bytes, ids: Any = None):
+        with self._lock:
+            self._payloads.append((version, time.monotonic(), ids, payload))
+
+    def missing(self) -> int:
+        """満杯まで補充するのに必要な件数"""
+        with self._lock:
+            return self.size - len(self._payloads)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._payloads),
+                "capacity": self.size,
+                "hits": self.hits,
+                "reused": self.reused,
+                "misses": self.misses,
+                "discarded": self.discarded,
+            }
@@ -0,0 +1,132 @@
+"""
+gunicornの複数ワーカー間で商品カタログを共有するためのスナップショット
+数値配列を.npyファイルとして書き出し、各ワーカーは読み取り専用のメモリマップで参照する
+（OSのページキャッシュを共有するため、ワーカーを増やしてもメモリ使用量は増えない）
+
+ディレクトリ構成:
+    publisher.lock           DBからの再構築を担当するワーカーが保持するロック
+    CURRENT                  公開中のスナップショット名（os.replaceでアトミックに切り替える）
+    catalog-v{version}-xxxx/ スナップショット本体
+"""
+import fcntl
+import json
+import os
+import shutil
+import uuid
+from typing import Optional
+
+import numpy as np
+
+from app.catalog import ProductCatalog, install_catalog
+from app.geo import GridIndex
+
+# メモリマップで共有する数値配列
+SHARED_FIELDS = (
+    "product_ids", "preferences", "preference_norms", "product_id_order", "product_code_order", "product_suppliers",
+    "supplier_ids", "supplier_lat", "supplier_lng", "supplier_offsets",
+)
+# 文字列の配列（メモリマップできないため各ワーカーで読み込む）
+OBJECT_FIELDS = ("product_codes", "names", "descriptions", "image_urls")
+
+CURRENT_FILE = "CURRENT"
+LOCK_FILE = "publisher.lock"
+SNAPSHOT_PREFIX = "catalog-"
+# 参照中のワーカーがいる可能性があるため、直前のスナップショットまでは残す
+KEEP_SNAPSHOTS = 2
+
+_lock_fd: Optional[int] = None
+_attached_name: Optional[str] = None
+
+
+def acquire_publisher_lock(directory: str) -> bool:
+    """再構築担当のロックを取得する（取得済みならTrue、他のワーカーが保持中ならFalse）"""
+    global _lock_fd
+    if _lock_fd is not None:
+        return True
+    os.makedirs(directory, exist_ok=True)
+    fd = os.open(os.path.join(directory, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return False
+    _lock_fd = fd
+    return True
+
+
+def publish_catalog(catalog: ProductCatalog, directory: str) -> str:
+    """カタログをスナップショットとして書き出し、CURRENTを切り替えて公開する"""
+    name = f"{SNAPSHOT_PREFIX}v{catalog.version}-{uuid.uuid4().hex[:8]}"
+    staging = os.path.join(directory, f".{name}")
+    os.makedirs(staging)
+    for field in SHARED_FIELDS + OBJECT_FIELDS:
+        np.save(os.path.join(staging, f"{field}.npy"), getattr(catalog, field))
+    with open(os.path.join(staging, "manifest.json"), "w") as f:
+        # ウォーターマークは差分更新のクエリ引数にそのまま使えるよう文字列で保存する
+        watermark = str(catalog.watermark) if catalog.watermark is not None else None
+        json.dump({
+            "version": catalog.version,
+            "loaded_at": catalog.loaded_at,
+            "watermark": watermark,
+            "scoring_version": catalog.scoring_version,
+        }, f)
+    os.rename(staging, os.path.join(directory, name))
+
+    current_tmp = os.path.join(directory, f".{CURRENT_FILE}.{os.getpid()}")
+    with open(current_tmp, "w") as f:
+        f.write(name)
+    os.replace(current_tmp, os.path.join(directory, CURRENT_FILE))
+
+    _remove_old_snapshots(directory)
+    return name
+
+
+def _remove_old_snapshots(directory: str):
+    # Linuxではメモリマップ中のファイルを削除しても、参照が外れるまで内容は保持される
+    snapshots = sorted(
+        (entry for entry in os.scandir(directory) if entry.is_dir() and entry.name.startswith(SNAPSHOT_PREFIX)),
+        key=lambda entry: entry.stat().st_mtime,
+        reverse=True,
+    )
+    for entry in snapshots[KEEP_SNAPSHOTS:]:
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def read_current(directory: str) -> Optional[str]:
+    """公開中のスナップショット名を返す（未公開の場合はNone）"""
+    try:
+        with open(os.path.join(directory, CURRENT_FILE)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def load_snapshot(directory: str, name: str) -> ProductCatalog:
+    """スナップショットを読み込む（数値配列は読み取り専用のメモリマップ）"""
+    path = os.path.join(directory, name)
+    with open(os.path.join(path, "manifest.json")) as f:
+        manifest = json.load(f)
+    arrays = {field: np.load(os.path.join(path, f"{field}.npy"), mmap_mode="r") for field in SHARED_FIELDS}
+    objects = {field: np.load(os.path.join(path, f"{field}.npy"), allow_pickle=True) for field in OBJECT_FIELDS}
+    return ProductCatalog(
+        version=manifest["version"],
+        loaded_at=manifest["loaded_at"],
+        watermark=manifest.get("watermark"),
+        spatial_index=GridIndex(arrays["supplier_lat"], arrays["supplier_lng"]),
+        scoring_version=manifest["scoring_version"],
+        snapshot_name=name,
+        **arrays,
+        **objects,
+    )
+
+
+def attach_shared_catalog(directory: str) -> Optional[ProductCatalog]:
+    """公開中のスナップショットが切り替わっていれば読み込んで差し替える（変化がなければNone）"""
+    global _attached_name
+    name = read_current(directory)
+    if name is None or name == _attached_name:
+        return None
+    catalog = load_snapshot(directory, name)
+    install_catalog(catalog)
+    _attached_name = name
+    return catalog
@@ -0,0 +1,134 @@
+"""
+リクエスト内の処理段階ごとの計測
+計測結果は Server-Timing ヘッダーとして返し、段階ごとのヒストグラムにも集計する
+"""
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+# ヒストグラムのバケット上限（ミリ秒）
+HISTOGRAM_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class StageTimer:
+    """1リクエスト分の段階別の所要時間を保持する"""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.handler_done_at: Optional[float] = None
+        self.stages: Dict[str, float] = {}
+
+    def add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def finish(self):
+        """レスポンス生成完了時に呼び、シリアライズと全体の時間を記録する"""
+        now = time.perf_counter()
+        if self.handler_done_at is not None:
+            self.add("serialize", now - self.handler_done_at)
+        self.add("total", now - self.started_at)
+
+    def header_value(self) -> str:
+        return ", ".join(f"{name};dur={seconds * 1000:.3f}" for name, seconds in self.stages.items())
+
+
+_current_timer: ContextVar[Optional[StageTimer]] = ContextVar("stage_timer", default=None)
+
+
+def start_timer() -> StageTimer:
+    """現在のリクエストに計測用のタイマーを設定する"""
+    timer = StageTimer()
+    _current_timer.set(timer)
+    return timer
+
+
+@contextmanager
+def stage(name: str):
+    """with stage("scoring"): のように処理段階を計測する（タイマー未設定時は何もしない）"""
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - started_at)
+
+
+def mark_handler_done():
+    """エンドポイントの処理完了を記録する（ここからレスポンス送信までをシリアライズ時間とみなす）"""
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.handler_done_at = time.perf_counter()
+
+
+class StageHistograms:
+    """段階ごとの所要時間の累積ヒストグラム"""
+
+    def __init__(self, buckets_ms=HISTOGRAM_BUCKETS_MS):
+        self.buckets_ms = buckets_ms
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, dict] = {}
+
+    def observe(self, timer: StageTimer):
+        with self._lock:
+            for name, seconds in timer.stages.items():
+                milliseconds = seconds * 1000
+                histogram = self._histograms.setdefault(
+                    name, {"count": 0, "sum_ms": 0.0, "counts": [0] * (len(self.buckets_ms) + 1)}
+                )
+                histogram["count"] += 1
+                histogram["sum_ms"] += milliseconds
+                bucket = next((i for i, upper in enumerate(self.buckets_ms) if milliseconds <= upper), len(self.buckets_ms))
+                histogram["counts"][bucket] += 1
+
+    def snapshot(self) -> dict:
+        """段階ごとの件数・合計・累積バケット（le=上限ms）を返す"""
+        with self._lock:
+            result = {}
+            for name, histogram in self._histograms.items():
+                cumulative = 0
+                buckets = {}
+                for upper, count in zip(list(self.buckets_ms) + ["+Inf"], histogram["counts"]):
+                    cumulative += count
+                    buckets[str(upper)] = cumulative
+                result[name] = {
+                    "count": histogram["count"],
+                    "sum_ms": round(histogram["sum_ms"], 3),
+                    "mean_ms": round(histogram["sum_ms"] / histogram["count"], 3),
+                    "buckets": buckets,
+                }
+            return result
+
+
+class ServerTimingMiddleware:
+    """
+    path_prefix で始まるパスのリクエストだけを計測し、Server-Timing ヘッダーを付けるASGIミドルウェア
+    それ以外のリクエストはパスを比較するだけでそのまま渡す
+    """
+
+    def __init__(self, app, histograms: StageHistograms, path_prefix: str):
+        self.app = app
+        self.histograms = histograms
+        self.path_prefix = path_prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.path_prefix):
+            await self.app(scope, receive, send)
+            return
+
+        timer = start_timer()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                timer.finish()
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timer.header_value().encode("latin-1")))
+                message = {**message, "headers": headers}
+                self.histograms.observe(timer)
+            await send(message)
+
+        await self.app(scope, receive, send_with_timing)
@@ -78,6 +78,8 @@ def create_mysql_tables():
                     global_trend INT DEFAULT 0,
                     smart_local INT DEFAULT 0,
                     smart_pick INT DEFAULT 0,
+                    -- 嗜好スコアの更新回数（レコメンドキャッシュの無効化に使用）
+                    preference_version INT NOT NULL DEFAULT 0,
                     INDEX idx_email (email)
                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
             """))
@@ -116,8 +118,13 @@ def create_mysql_tables():
                     global_trend INT DEFAULT 0,
                     smart_local INT DEFAULT 0,
                     smart_pick INT DEFAULT 0,
+                    -- 範囲検索用にlocationから緯度経度を展開した生成カラム
+                    lat DOUBLE GENERATED ALWAYS AS (location->>'$.lat') STORED,
+                    lng DOUBLE GENERATED ALWAYS AS (location->>'$.lng') STORED,
                     INDEX idx_name (name),
-                    INDEX idx_city (city)
+                    INDEX idx_city (city),
+                    INDEX idx_lat_lng (lat, lng),
+                    INDEX idx_updated_at (updated_at)
                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
             """))
             
@@ -155,7 +162,8 @@ def create_mysql_tables():
                     FOREIGN KEY (supplier_id) REFERENCES suppliers (supplier_id),
                     INDEX idx_product_code (product_code),
                     INDEX idx_supplier_id (supplier_id),
-                    INDEX idx_category (category)
+                    INDEX idx_category (category),
+                    INDEX idx_updated_at (updated_at)
                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
             """))
             
@@ -191,6 +199,23 @@ def create_mysql_tables():
                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
             """))
             
+            # 6. recommendations_cacheテーブル作成（precompute_recommendations.pyで事前計算したレコメンド）
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS recommendations_cache (
+                    user_id INT NOT NULL,
+                    cell_lat INT NOT NULL,
+                    cell_lng INT NOT NULL,
+                    preference_version INT NOT NULL,
+                    catalog_version VARCHAR(32) NULL,
+                    product_ids JSON NOT NULL,
+                    match_scores JSON NOT NULL,
+                    total_matches INT NOT NULL,
+                    computed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                    PRIMARY KEY (user_id, cell_lat, cell_lng),
+                    FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+            """))
+            
             # コミット
             conn.commit()
             print("MySQLテーブルが正常に作成されました")
@@ -47,7 +47,9 @@ def create_tables():
                 design_master INTEGER DEFAULT 0,
                 global_trend INTEGER DEFAULT 0,
                 smart_local INTEGER DEFAULT 0,
-                smart_pick INTEGER DEFAULT 0
+                smart_pick INTEGER DEFAULT 0,
+                -- 嗜好スコアの更新回数（レコメンドキャッシュの無効化に使用）
+                preference_version INTEGER NOT NULL DEFAULT 0
             )
         """)
         
@@ -84,9 +86,22 @@ def create_tables():
                 design_master INTEGER DEFAULT 0,
                 global_trend INTEGER DEFAULT 0,
                 smart_local INTEGER DEFAULT 0,
-                smart_pick INTEGER DEFAULT 0
+                smart_pick INTEGER DEFAULT 0,
+                -- 範囲検索用にlocationから緯度経度を展開した生成カラム
+                lat REAL GENERATED ALWAYS AS (json_extract(location, '$.lat')) VIRTUAL,
+                lng REAL GENERATED ALWAYS AS (json_extract(location, '$.lng')) VIRTUAL
             )
         """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_suppliers_lat_lng ON suppliers (lat, lng)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_suppliers_updated_at ON suppliers (updated_at)")
+        # MySQLの ON UPDATE CURRENT_TIMESTAMP に相当（カタログの差分更新に使用）
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_suppliers_updated_at AFTER UPDATE ON suppliers
+            WHEN NEW.updated_at IS OLD.updated_at
+            BEGIN
+                UPDATE suppliers SET updated_at = CURRENT_TIMESTAMP WHERE supplier_id = NEW.supplier_id;
+            END
+        """)
         
         # 3. productsテーブル作成
         cursor.execute("""
@@ -122,6 +137,14 @@ def create_tables():
                 FOREIGN KEY (supplier_id) REFERENCES suppliers (supplier_id)
             )
         """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_updated_at ON products (updated_at)")
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_products_updated_at AFTER UPDATE ON products
+            WHEN NEW.updated_at IS OLD.updated_at
+            BEGIN
+                UPDATE products SET updated_at = CURRENT_TIMESTAMP WHERE product_id = NEW.product_id;
+            END
+        """)
         
         # 4. favoritesテーブル作成
         cursor.execute("""
@@ -153,6 +176,23 @@ def create_tables():
             )
         """)
         
+        # 6. recommendations_cacheテーブル作成（precompute_recommendations.pyで事前計算したレコメンド）
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS recommendations_cache (
+                user_id INTEGER NOT NULL,
+                cell_lat INTEGER NOT NULL,
+                cell_lng INTEGER NOT NULL,
+                preference_version INTEGER NOT NULL,  -- 計算時のusers.preference_version
+                catalog_version TEXT,  -- 計算時のカタログのscoring_version
+                product_ids TEXT NOT NULL,  -- JSON形式で保存（スコア順）
+                match_scores TEXT NOT NULL,  -- JSON形式で保存
+                total_matches INTEGER NOT NULL,
+                computed_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, cell_lat, cell_lng),
+                FOREIGN KEY (user_id) REFERENCES users (user_id)
+            )
+        """)
+        
         # コミット
         conn.commit()
         print("テーブルが正常に作成されました")
@@ -176,7 +216,7 @@ def verify_tables():
     
     try:
         # 各テーブルの構造を確認
-        tables = ['users', 'suppliers', 'products', 'favorites', 'destinated']
+        tables = ['users', 'suppliers', 'products', 'favorites', 'destinated', 'recommendations_cache']
         
         for table in tables:
             print(f"\n--- {table}テーブル構造 ---")
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+全国レコメンドのANNインデックスについて、完全スコアリングの上位k件に対する再現率(recall@k)を測定するスクリプト
+カタログから抽出した商品の嗜好ベクトルをクエリとして使う（全件のスコアリングを行うため、APIとは別に実行する）
+
+環境変数:
+    ANN_N_PROBE    検索時に調べるクラスタ数（APIと同じ値で測定する）
+    ANN_N_LISTS    クラスタ数（0の場合は商品数の平方根）
+    ANN_RECALL_K        上位何件で測定するか
+    ANN_RECALL_SAMPLES  クエリ数
+"""
+import os
+import sys
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from app.ann import IVFIndex, recall_at_k
+from app.catalog import refresh_catalog
+from migrate_schema import get_engine
+
+N_PROBE = int(os.getenv('ANN_N_PROBE', '8'))
+N_LISTS = int(os.getenv('ANN_N_LISTS', '0'))
+K = int(os.getenv('ANN_RECALL_K', '20'))
+SAMPLES = int(os.getenv('ANN_RECALL_SAMPLES', '100'))
+
+def measure():
+    engine = get_engine()
+    if not engine:
+        return False
+    try:
+        with Session(engine) as db:
+            catalog = refresh_catalog(db)
+        if len(catalog) == 0:
+            print("商品がありません")
+            return False
+        index = IVFIndex.build_for_catalog(catalog, N_LISTS or None)
+        rng = np.random.default_rng()
+        query_vectors = catalog.preferences[rng.choice(len(catalog), min(SAMPLES, len(catalog)), replace=False)]
+        for key, value in recall_at_k(catalog, index, query_vectors, K, N_PROBE).items():
+            print(f"{key}: {value}")
+        return True
+    except Exception as e:
+        print(f"エラーが発生しました: {e}")
+        return False
+
+if __name__ == "__main__":
+    print("ANN再現率の測定スクリプト")
+    print("=" * 50)
+    if not measure():
+        sys.exit(1)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+既存データベースのスキーマを最新の構造に合わせるマイグレーションスクリプト
+各マイグレーションは適用済みであれば何もしないため、繰り返し実行できる
+"""
+import os
+import sys
+from sqlalchemy import create_engine, text, inspect
+from dotenv import load_dotenv
+
+# 環境変数を読み込み
+load_dotenv()
+
+# SQLiteのデータベースファイル名（main.pyと同じ）
+DB_FILENAME = "souveni_go.db"
+
+def get_engine():
+    """DEV_MODEに応じてSQLiteまたはMySQLのエンジンを取得"""
+    if os.getenv('DEV_MODE', 'false').lower() == 'true':
+        return create_engine(f"sqlite:///{DB_FILENAME}")
+    from create_mysql_tables import get_mysql_engine
+    return get_mysql_engine()
+
+def get_columns(conn, table):
+    """テーブルのカラム名一覧を取得（SQLiteの生成カラムも含む）"""
+    if conn.dialect.name == "sqlite":
+        # PRAGMA table_infoは生成カラムを返さないため、xinfoを使う
+        return [row[1] for row in conn.execute(text(f"PRAGMA table_xinfo({table})"))]
+    return [column["name"] for column in inspect(conn).get_columns(table)]
+
+# --- マイグレーション定義 ---
+def add_supplier_lat_lng(conn):
+    """
+    suppliersにlocation(JSON)から展開した緯度経度の生成カラム(lat/lng)を追加する
+    既存データのバックフィルと以後の同期はDB側で行われる
+    """
+    if "lat" in get_columns(conn, "suppliers"):
+        return False
+    if conn.dialect.name == "sqlite":
+        conn.execute(text("ALTER TABLE suppliers ADD COLUMN lat REAL GENERATED ALWAYS AS (json_extract(location, '$.lat')) VIRTUAL"))
+        conn.execute(text("ALTER TABLE suppliers ADD COLUMN lng REAL GENERATED ALWAYS AS (json_extract(location, '$.lng')) VIRTUAL"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_suppliers_lat_lng ON suppliers (lat, lng)"))
+    else:
+        # STORED の生成カラムはALTER時に全行が計算されるため、これがバックフィルを兼ねる
+        conn.execute(text("""
+            ALTER TABLE suppliers
+                ADD COLUMN lat DOUBLE GENERATED ALWAYS AS (location->>'$.lat') STORED,
+                ADD COLUMN lng DOUBLE GENERATED ALWAYS AS (location->>'$.lng') STORED,
+                ADD INDEX idx_lat_lng (lat, lng)
+        """))
+    total = conn.execute(text("SELECT COUNT(*) FROM suppliers")).scalar()
+    located = conn.execute(text("SELECT COUNT(*) FROM suppliers WHERE lat IS NOT NULL AND lng IS NOT NULL")).scalar()
+    print(f"  {located}/{total} 件の仕入先に緯度経度が設定されています")
+    return True
+
+def add_user_preference_version(conn):
+    """usersに嗜好スコアの更新回数(preference_version)を追加する（レコメンドキャッシュの無効化に使用）"""
+    if "preference_version" in get_columns(conn, "users"):
+        return False
+    conn.execute(text("ALTER TABLE users ADD COLUMN preference_version INT NOT NULL DEFAULT 0"))
+    return True
+
+def add_updated_at_tracking(conn):
+    """
+    products/suppliersのupdated_atにインデックスを追加する（カタログの差分更新に使用）
+    SQLiteには ON UPDATE CURRENT_TIMESTAMP がないため、同等のトリガーも追加する
+    """
+    applied = False
+    for table, key in (("products", "product_id"), ("suppliers", "supplier_id")):
+        if conn.dialect.name == "sqlite":
+            index = f"idx_{table}_updated_at"
+            if conn.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = :name"), {"name": f"trg_{table}_updated_at"}).first() is None:
+                conn.execute(text(f"""
+                    CREATE TRIGGER trg_{table}_updated_at AFTER UPDATE ON {table}
+                    WHEN NEW.updated_at IS OLD.updated_at
+                    BEGIN
+                        UPDATE {table} SET updated_at = CURRENT_TIMESTAMP WHERE {key} = NEW.{key};
+                    END
+                """))
+                applied = True
+        else:
+            index = "idx_updated_at"
+        if index not in [idx["name"] for idx in inspect(conn).get_indexes(table)]:
+            conn.execute(text(f"CREATE INDEX {index} ON {table} (updated_at)"))
+            applied = True
+    return applied
+
+def add_recommendations_cache(conn):
+    """事前計算したレコメンドを保存するrecommendations_cacheテーブルを追加する"""
+    if inspect(conn).has_table("recommendations_cache"):
+        return False
+    if conn.dialect.name == "sqlite":
+        conn.execute(text("""
+            CREATE TABLE recommendations_cache (
+                user_id INTEGER NOT NULL,
+                cell_lat INTEGER NOT NULL,
+                cell_lng INTEGER NOT NULL,
+                preference_version INTEGER NOT NULL,
+                product_ids TEXT NOT NULL,
+                match_scores TEXT NOT NULL,
+                total_matches INTEGER NOT NULL,
+                computed_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, cell_lat, cell_lng),
+                FOREIGN KEY (user_id) REFERENCES users (user_id)
+            )
+        """))
+    else:
+        conn.execute(text("""
+            CREATE TABLE recommendations_cache (
+                user_id INT NOT NULL,
+                cell_lat INT NOT NULL,
+                cell_lng INT NOT NULL,
+                preference_version INT NOT NULL,
+                product_ids JSON NOT NULL,
+                match_scores JSON NOT NULL,
+                total_matches INT NOT NULL,
+                computed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, cell_lat, cell_lng),
+                FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+        """))
+    return True
+
+def add_recommendations_cache_catalog_version(conn):
+    """
+    recommendations_cacheに計算時のカタログのバージョン(catalog_version)を追加する
+    既存の行はNULLとなり、APIでは使われない（precompute_recommendations.pyで再計算する）
+    """
+    if "catalog_version" in get_columns(conn, "recommendations_cache"):
+        return False
+    conn.execute(text("ALTER TABLE recommendations_cache ADD COLUMN catalog_version VARCHAR(32) NULL"))
+    return True
+
+MIGRATIONS = [
+    add_supplier_lat_lng,
+    add_user_preference_version,
+    add_updated_at_tracking,
+    add_recommendations_cache,
+    add_recommendations_cache_catalog_version,
+]
+
+def migrate():
+    """未適用のマイグレーションを順に実行する"""
+    engine = get_engine()
+    if not engine:
+        return False
+
+    try:
+        with engine.connect() as conn:
+            for migration in MIGRATIONS:
+                print(f"{migration.__name__}:")
+                applied = migration(conn)
+                conn.commit()
+                print("  適用しました" if applied else "  適用済みのためスキップしました")
+        return True
+    except Exception as e:
+        print(f"エラーが発生しました: {e}")
+        return False
+
+if __name__ == "__main__":
+    print("スキーママイグレーション")
+    print("=" * 50)
+    if not migrate():
+        sys.exit(1)
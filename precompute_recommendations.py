@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+人気エリア（ホットスポット）のセル毎に、全ユーザーのレコメンド上位N件を事前計算して
+recommendations_cache テーブルに保存するバッチスクリプト
+APIは同じセルからのリクエストをこのテーブルの主キー検索だけで返す（cronなどで定期的に実行する）
+
+環境変数:
+    PRECOMPUTED_CELL_DEG   セルの大きさ（度）。APIと同じ値にすること
+    PRECOMPUTED_TOP_N      ユーザー×セル毎に保存する件数
+    PRECOMPUTED_HOTSPOTS   対象とするセル数（商品数の多い順）
+"""
+import os
+import sys
+import time
+
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from app.catalog import PREFERENCE_KEYS, refresh_catalog
+from app.precomputed import (
+    DEFAULT_CELL_DEG, DEFAULT_TOP_N, cell_center, find_hotspot_cells, precompute_cell, save_precomputed,
+)
+from app.scoring import RECOMMENDATION_RADIUS_KM
+from migrate_schema import get_engine
+
+CELL_DEG = float(os.getenv('PRECOMPUTED_CELL_DEG', str(DEFAULT_CELL_DEG)))
+TOP_N = int(os.getenv('PRECOMPUTED_TOP_N', str(DEFAULT_TOP_N)))
+HOTSPOTS = int(os.getenv('PRECOMPUTED_HOTSPOTS', '50'))
+# 1回の行列積で計算するユーザー数
+USER_CHUNK = 1000
+
+def precompute():
+    """ホットスポットのセル×全ユーザーのレコメンドを計算して保存する"""
+    engine = get_engine()
+    if not engine:
+        return False
+
+    started_at = time.perf_counter()
+    try:
+        with Session(engine) as db:
+            catalog = refresh_catalog(db)
+            users = db.execute(text(f"SELECT user_id, preference_version, {', '.join(PREFERENCE_KEYS)} FROM users")).fetchall()
+        print(f"商品: {len(catalog)} 件, ユーザー: {len(users)} 人")
+
+        cells = find_hotspot_cells(catalog, HOTSPOTS, CELL_DEG)
+        saved = 0
+        with engine.connect() as conn:
+            for cell in cells:
+                center = cell_center(cell, CELL_DEG)
+                for start in range(0, len(users), USER_CHUNK):
+                    chunk = users[start:start + USER_CHUNK]
+                    user_matrix = np.array([[getattr(user, key) or 0 for key in PREFERENCE_KEYS] for user in chunk])
+                    entries = precompute_cell(catalog, user_matrix, cell, RECOMMENDATION_RADIUS_KM, TOP_N, CELL_DEG)
+                    for user, entry in zip(chunk, entries):
+                        save_precomputed(conn, user.user_id, cell, user.preference_version, catalog.scoring_version, entry)
+                    saved += len(chunk)
+                # セル単位でコミットし、途中で失敗しても計算済みのセルは使えるようにする
+                conn.commit()
+                print(f"  セル {cell} (中心 {center[0]:.4f}, {center[1]:.4f}) を保存しました")
+        print(f"{len(cells)} セル, {saved} 件を {time.perf_counter() - started_at:.1f} 秒で保存しました")
+        return True
+    except Exception as e:
+        print(f"エラーが発生しました: {e}")
+        return False
+
+if __name__ == "__main__":
+    print("レコメンド事前計算スクリプト")
+    print("=" * 50)
+    if not precompute():
+        sys.exit(1)
@@ -0,0 +1,135 @@
+"""
+整数化したスコアリング（integer_dots / cosine_match_percentages）が、
+float64の参照実装と従来の1行ずつのループと同じスコア・同じ順位になることを確認する
+"""
+import numpy as np
+import pytest
+
+from app.pagination import top_k_indices
+from app.scoring import (
+    DOT_CHUNK_ROWS, FLOAT32_EXACT_LIMIT, compact_preference_matrix, compute_row_norms,
+    cosine_match_percentage_matrix, cosine_match_percentages, integer_dots,
+)
+
+N_DIMS = 16
+
+
+def loop_match_percentages(user_vector, matrix):
+    """従来の recommend_from_db と同じ1行ずつの計算"""
+    scores = []
+    for product_vector in matrix:
+        dot_product = np.dot(user_vector, product_vector)
+        norm_user = np.linalg.norm(user_vector)
+        norm_product = np.linalg.norm(product_vector)
+        score = 0
+        if norm_user > 0 and norm_product > 0:
+            score = dot_product / (norm_user * norm_product)
+        scores.append(int(score * 100))
+    return np.array(scores, dtype=np.int64)
+
+
+def float64_match_percentages(user_vector, matrix):
+    matrix = np.asarray(matrix, dtype=np.float64)
+    user_vector = np.asarray(user_vector, dtype=np.float64)
+    denominators = np.linalg.norm(matrix, axis=1) * np.linalg.norm(user_vector)
+    scores = np.zeros(len(matrix))
+    np.divide(matrix @ user_vector, denominators, out=scores, where=denominators > 0)
+    return np.trunc(scores * 100).astype(np.int64)
+
+
+def ranking(scores, product_ids):
+    return product_ids[top_k_indices(scores, product_ids, len(scores))]
+
+
+def make_matrix(rng, low, high, rows=500):
+    matrix = rng.integers(low, high + 1, (rows, N_DIMS))
+    # ノルムが0の行も含める
+    matrix[:3] = 0
+    return matrix
+
+
+# (値の範囲, 圧縮後の型)。int16 は1バイトでないため整数の行列積にフォールバックする
+DTYPE_CASES = [
+    ((0, 100), np.uint8),
+    ((-100, 100), np.int8),
+    ((-1000, 1000), np.int16),
+]
+
+
+@pytest.mark.parametrize("value_range, dtype", DTYPE_CASES)
+def test_compact_preference_matrix_dtype(value_range, dtype):
+    matrix = make_matrix(np.random.default_rng(0), *value_range)
+    assert compact_preference_matrix(matrix).dtype == dtype
+
+
+@pytest.mark.parametrize("value_range, dtype", DTYPE_CASES)
+def test_integer_dots_exact(value_range, dtype):
+    rng = np.random.default_rng(1)
+    matrix = make_matrix(rng, *value_range)
+    compact = compact_preference_matrix(matrix)
+    for user_vector in (rng.integers(-100, 101, N_DIMS), rng.integers(0, 101, N_DIMS), np.zeros(N_DIMS, dtype=np.int64)):
+        dots = integer_dots(compact, user_vector)
+        assert dots.dtype == np.int64
+        np.testing.assert_array_equal(dots, matrix.astype(np.int64) @ user_vector)
+
+
+def test_integer_dots_float32_path_across_chunks():
+    """float32のBLASで計算する範囲で、チャンクの境界をまたいでも整数演算と一致する"""
+    rng = np.random.default_rng(2)
+    matrix = rng.integers(0, 256, (DOT_CHUNK_ROWS * 2 + 7, N_DIMS)).astype(np.uint8)
+    user_vectors = rng.integers(0, 101, (N_DIMS, 5))
+    assert 255 * np.abs(user_vectors).sum(axis=0).max() < FLOAT32_EXACT_LIMIT
+    np.testing.assert_array_equal(integer_dots(matrix, user_vectors), matrix.astype(np.int64) @ user_vectors)
+
+
+def test_integer_dots_large_vector_falls_back():
+    """途中の和が2^24以上になり得る場合はint64で計算する"""
+    rng = np.random.default_rng(3)
+    matrix = rng.integers(0, 256, (100, N_DIMS)).astype(np.uint8)
+    user_vector = np.full(N_DIMS, FLOAT32_EXACT_LIMIT // N_DIMS, dtype=np.int64) + rng.integers(0, 1000, N_DIMS)
+    np.testing.assert_array_equal(integer_dots(matrix, user_vector), matrix.astype(np.int64) @ user_vector)
+
+
+def test_integer_dots_float_vector():
+    rng = np.random.default_rng(4)
+    matrix = rng.integers(0, 101, (100, N_DIMS)).astype(np.uint8)
+    user_vector = rng.random(N_DIMS)
+    np.testing.assert_allclose(integer_dots(matrix, user_vector), matrix.astype(np.float64) @ user_vector)
+
+
+@pytest.mark.parametrize("value_range, dtype", DTYPE_CASES)
+def test_cosine_match_percentages_match_references(value_range, dtype):
+    rng = np.random.default_rng(5)
+    matrix = make_matrix(rng, *value_range)
+    compact = compact_preference_matrix(matrix)
+    row_norms = compute_row_norms(matrix)
+    product_ids = rng.permutation(len(matrix))
+    for _ in range(20):
+        user_vector = rng.integers(-100, 101, N_DIMS) if value_range[0] < 0 else rng.integers(0, 101, N_DIMS)
+        scores = cosine_match_percentages(user_vector, compact, row_norms)
+        np.testing.assert_array_equal(scores, float64_match_percentages(user_vector, matrix))
+        np.testing.assert_array_equal(scores, loop_match_percentages(user_vector, matrix))
+        np.testing.assert_array_equal(
+            ranking(scores, product_ids), ranking(loop_match_percentages(user_vector, matrix), product_ids)
+        )
+
+
+def test_cosine_match_percentages_zero_user_vector():
+    matrix = make_matrix(np.random.default_rng(6), 0, 100)
+    scores = cosine_match_percentages(np.zeros(N_DIMS), compact_preference_matrix(matrix), compute_row_norms(matrix))
+    np.testing.assert_array_equal(scores, np.zeros(len(matrix), dtype=np.int64))
+
+
+@pytest.mark.parametrize("value_range, dtype", DTYPE_CASES)
+def test_cosine_match_percentage_matrix_matches_single_user(value_range, dtype):
+    rng = np.random.default_rng(7)
+    matrix = make_matrix(rng, *value_range)
+    compact = compact_preference_matrix(matrix)
+    row_norms = compute_row_norms(matrix)
+    user_matrix = rng.integers(0, 101, (12, N_DIMS))
+    user_matrix[0] = 0
+    score_matrix = cosine_match_percentage_matrix(user_matrix, compact, row_norms)
+    assert score_matrix.shape == (len(matrix), len(user_matrix))
+    for j, user_vector in enumerate(user_matrix):
+        np.testing.assert_array_equal(score_matrix[:, j], cosine_match_percentages(user_vector, compact, row_norms))
+        np.testing.assert_array_equal(score_matrix[:, j], loop_match_percentages(user_vector, matrix))